@@ -1,9 +1,20 @@
 #!/usr/bin/env python3
 
+"""Render the sentiment plots and maps from the CSV outputs of reddit_model.py."""
+
 # May first need:
 # In your VM: sudo apt-get install libgeos-dev (brew install on Mac)
 # pip3 install https://github.com/matplotlib/basemap/archive/v1.1.0.tar.gz
 
+import os
+import sys
+import glob
+import json
+import zipfile
+import hashlib
+import argparse
+import tempfile
+import multiprocessing
 import matplotlib
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
@@ -11,8 +22,8 @@ import pandas as pd
 import datetime
 import numpy as np
 
-from mpl_toolkits.basemap import Basemap as Basemap
-from matplotlib.colors import rgb2hex
+from matplotlib.colors import Normalize
+from matplotlib.collections import PatchCollection
 from matplotlib.patches import Polygon
 
 """
@@ -29,38 +40,86 @@ There are a few things missing:
    about adding them back.
 """
 
+# The columns of the outputs of reddit_model.py, each a directory of Spark part files
+# (name.csv, or name.parquet) in the input directory
+# Outputs of runs before the sums and counts were added lack those columns.
+TOTALS = {'Positive': 'float64', 'Negative': 'float64', 'sum_pos': 'int64', 'sum_neg': 'int64', 'count': 'int64'}
+BINS = dict(TOTALS, bin='int64', score_low='int64', score_high='int64')
+INPUTS = {
+    'totalPercent': dict(TOTALS, title='object'),
+    'time_data': dict(TOTALS, date='object'),
+    'state_data': dict(TOTALS, state='object'),
+    'submission_score': dict(TOTALS, submission_score='int64'),
+    'comment_score': dict(TOTALS, comment_score='int64'),
+    'submission_score_bins': BINS,
+    'comment_score_bins': BINS,
+}
+# Score bins per power of ten, the same as reddit_model.BINS_PER_DECADE
+BINS_PER_DECADE = 10
+# Hashes of the inputs of every plot at its last render
+RENDER_STATE = ".render_state.json"
+
+
+def output_files(input_dir, name):
+    """Returns the part files of an output, Parquet ones if it was saved as Parquet."""
+    for directory in [name + '.parquet', name + '.csv']:
+        for pattern in ['part-*.parquet', 'part-*.csv']:
+            parts = sorted(glob.glob(os.path.join(input_dir, directory, pattern)))
+            if parts:
+                return parts
+    raise IOError("No part files of {} in {}".format(name, input_dir))
+
+
+def read_output(input_dir, name):
+    """Reads every part file of an output into one DataFrame."""
+    dtypes = INPUTS[name]
+    parts = output_files(input_dir, name)
+    if parts[0].endswith('.parquet'):
+        frame = pd.read_parquet(os.path.dirname(parts[0]))
+        frame = frame[[column for column in frame.columns if column in dtypes]]
+        return frame.astype(dict((column, dtypes[column]) for column in frame.columns))
+    # The C parser with the types given, every part has its own header. Spark writes
+    # empty files for empty partitions.
+    frames = [pd.read_csv(part, engine='c', usecols=lambda column: column in dtypes, dtype=dtypes)
+              for part in parts if os.path.getsize(part)]
+    if not frames:
+        # An empty output, every part file is empty
+        return pd.DataFrame(dict((column, pd.Series(dtype=dtype)) for column, dtype in dtypes.items()))
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, ignore_index=True)
+
 
 """
 PLOT 1: SENTIMENT OVER TIME (TIME SERIES PLOT)
 """
-# Assumes a file called time_data.csv that has columns
-# date, Positive, Negative. Use absolute path.
-
-ts = pd.read_csv("time_data.csv/part-00000-30274a3f-99fd-4f40-b70d-0f4e9a663ae3-c000.csv", engine='python')
-# Remove erroneous row.
-ts = ts[ts['date'] != '2018-12-31']
+def plot_time_series(input_dir, path):
+    # Assumes a file called time_data.csv that has columns
+    # date, Positive, Negative.
+    ts = read_output(input_dir, 'time_data')
+    # Remove erroneous row.
+    ts = ts[ts['date'] != '2018-12-31']
+
+    ts.date = pd.to_datetime(ts['date'], format='%Y-%m-%d')
+    ts.set_index(['date'], inplace=True)
+    # Only the averages, the sums and counts are on another scale
+    ts = ts[['Positive', 'Negative']]
+
+    fig = plt.figure(figsize=(12,5))
+    ts.plot(ax=fig.add_subplot(111),
+            title="President Trump Sentiment on /r/politics Over Time",
+            color=['green', 'red'],
+            ylim=(0, 1.05))
+    fig.savefig(path)
+    plt.close(fig)
 
-plt.figure(figsize=(12,5))
-ts.date = pd.to_datetime(ts['date'], format='%Y-%m-%d')
-ts.set_index(['date'],inplace=True)
-
-ax = ts.plot(title="President Trump Sentiment on /r/politics Over Time",
-        color=['green', 'red'],
-       ylim=(0, 1.05))
-ax.plot()
-plt.savefig("part1.png")
 
 """
 PLOT 2: SENTIMENT BY STATE (POSITIVE AND NEGATIVE SEPARATELY)
-# This example only shows positive, I will leave negative to you.
 """
 
 # This assumes you have a CSV file called "state_data.csv" with the columns:
 # state, Positive, Negative
-#
-# You should use the FULL PATH to the file, just in case.
-
-state_data = pd.read_csv("state_data.csv/part-00000-605e02a6-1d5e-45ed-b662-757a30435fde-c000.csv", engine='python')
 
 """
 You also need to download the following files. Put them somewhere convenient:
@@ -75,100 +134,170 @@ The rename the files to get rid of the ?raw=true
 """
 
 # Lambert Conformal map of lower 48 states.
-m = Basemap(llcrnrlon=-119, llcrnrlat=22, urcrnrlon=-64, urcrnrlat=49,
+PROJECTION = dict(llcrnrlon=-119, llcrnrlat=22, urcrnrlon=-64, urcrnrlat=49,
         projection='lcc', lat_1=33, lat_2=45, lon_0=-95)
-shp_info = m.readshapefile('st99_d00','states',drawbounds=True)  # No extension specified in path here.
-pos_data = dict(zip(state_data.state, state_data.Positive))
-neg_data = dict(zip(state_data.state, state_data.Negative))
-
-# choose a color for each state based on sentiment.
-pos_colors = {}
-statenames = []
-pos_cmap = plt.cm.YlGn #used cool colormap
-
-vmin = 0; vmax = 1 # set range.
-for shapedict in m.states_info:
-    statename = shapedict['NAME']
-    # skip DC and Puerto Rico.
-    if statename not in ['District of Columbia', 'Puerto Rico']:
-        pos = pos_data[statename]
-        pos_colors[statename] = pos_cmap(( pos - vmin )/( vmax - vmin))[:3]
-    statenames.append(statename)
-# cycle through state names, color each one.
+SHAPEFILE = 'st99_d00'  # No extension specified in path here.
+GEOMETRY_CACHE = SHAPEFILE + '.lcc.npz'
+# skip DC and Puerto Rico.
+SKIPPED_STATES = ['District of Columbia', 'Puerto Rico']
+
+
+def load_state_geometry(shapefile=SHAPEFILE, cache=GEOMETRY_CACHE):
+    """Returns the state names, projected polygons and map extent, parsing the shapefile only once."""
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(shapefile + '.shp'):
+        try:
+            saved = np.load(cache)
+            if str(saved['projection']) == repr(sorted(PROJECTION.items())):
+                # Every polygon is a slice of one coordinate array
+                bounds = saved['offsets']
+                polygons = [saved['coordinates'][bounds[i]:bounds[i + 1]] for i in range(len(bounds) - 1)]
+                return list(saved['names']), polygons, tuple(saved['extent'])
+        except (IOError, OSError, ValueError, KeyError, zipfile.BadZipfile):
+            # An unreadable cache is parsed and written again
+            pass
+
+    # Basemap is only needed to parse and project the shapefile
+    from mpl_toolkits.basemap import Basemap as Basemap
+    m = Basemap(**PROJECTION)
+    m.readshapefile(shapefile, 'states', drawbounds=False)
+    names = [shapedict['NAME'] for shapedict in m.states_info]
+    polygons = [np.asarray(seg, dtype=np.float64) for seg in m.states]
+    extent = (m.llcrnrx, m.urcrnrx, m.llcrnry, m.urcrnry)
+    # Written aside and renamed into place, render's workers may all be parsing it at once
+    fd, partial = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(os.path.abspath(cache)))
+    try:
+        with os.fdopen(fd, 'wb') as saved:
+            np.savez(saved, names=np.array(names), offsets=np.cumsum([0] + [len(polygon) for polygon in polygons]),
+                     coordinates=np.concatenate(polygons), extent=np.array(extent),
+                     projection=np.array(repr(sorted(PROJECTION.items()))))
+        os.replace(partial, cache)
+    except BaseException:
+        os.remove(partial)
+        raise
+    return names, polygons, extent
+
+
+# The map figure of this process, see state_map
+_state_map = None
+
+def state_map():
+    """Returns this process's map figure, its axes, state polygon collection and the state of each polygon."""
+    # One figure and one collection of all the state polygons, only the colors and the title
+    # change between the maps, so no map is drawn over another
+    global _state_map
+    if _state_map is None:
+        names, polygons, extent = load_state_geometry()
+        kept = [name not in SKIPPED_STATES for name in names]
+        figure = plt.figure()
+        axes = figure.add_subplot(111)
+        collection = PatchCollection([Polygon(polygon) for polygon, keep in zip(polygons, kept) if keep])
+        axes.add_collection(collection)
+        axes.set_xlim(extent[0], extent[1])
+        axes.set_ylim(extent[2], extent[3])
+        axes.set_aspect('equal')
+        axes.axis('off')
+        _state_map = (figure, axes, collection, pd.Series([name for name, keep in zip(names, kept) if keep]))
+    return _state_map
+
+
+def draw_state_map(values, vmin, vmax, cmap, title, path):
+    """Colors every state by its value in values (a dict by state name) and saves the map."""
+    figure, axes, collection, shape_names = state_map()
+    # choose a color for each state based on sentiment, all states at once.
+    # States with no data get the colormap's "bad" color.
+    shades = np.ma.masked_invalid(shape_names.map(values).astype(float).values)
+    colors = cmap(Normalize(vmin, vmax)(shades))
+    collection.set_facecolor(colors)
+    collection.set_edgecolor(colors)
+    axes.set_title(title)
+    figure.savefig(path)
+
+
+def state_sentiment(input_dir):
+    """Returns the positive and negative sentiment by state name."""
+    state_data = read_output(input_dir, 'state_data')
+    return dict(zip(state_data.state, state_data.Positive)), dict(zip(state_data.state, state_data.Negative))
+
 
 # POSITIVE MAP
-ax = plt.gca() # get current axes instance
-
-for nshape, seg in enumerate(m.states):
-    # skip Puerto Rico and DC
-    if statenames[nshape] not in ['District of Columbia', 'Puerto Rico']:
-        color = rgb2hex(pos_colors[statenames[nshape]])
-        poly = Polygon(seg, facecolor=color, edgecolor=color)
-        ax.add_patch(poly)
-plt.title('Positive Trump Sentiment Across the US')
-plt.savefig("positiveMap.png")
-
-# choose a color for each state based on sentiment.
-neg_colors = {}
-neg_cmap = plt.cm.YlGn
-
-for shapedict in m.states_info:
-    statename = shapedict['NAME']
-		# skip DC and Puerto Rico.
-    if statename not in ['District of Columbia', 'Puerto Rico']:
-        neg = neg_data[statename]
-        neg_colors[statename] = neg_cmap((( neg - vmin )/( vmax - vmin )))[:3]
-    statenames.append(statename)
-# cycle through state names, color each one.
+def plot_positive_map(input_dir, path):
+    pos_data, neg_data = state_sentiment(input_dir)
+    draw_state_map(pos_data, 0, 1, plt.cm.YlGn, 'Positive Trump Sentiment Across the US', path)
+
 
 # NEGATIVE MAP
-ax = plt.gca() # get current axes instance
-for nshape, seg in enumerate(m.states):
-		# skip Puerto Rico and DC
-    if statenames[nshape] not in ['District of Columbia', 'Puerto Rico']:
-        color = rgb2hex(neg_colors[statenames[nshape]])
-        poly = Polygon(seg, facecolor=color, edgecolor=color)
-        ax.add_patch(poly)
-plt.title('Negative Trump Sentiment Across the US')
-plt.savefig("negativeMap.png")
+def plot_negative_map(input_dir, path):
+    pos_data, neg_data = state_sentiment(input_dir)
+    draw_state_map(neg_data, 0, 1, plt.cm.YlGn, 'Negative Trump Sentiment Across the US', path)
 
 # SOURCE: https://stackoverflow.com/questions/39742305/how-to-use-basemap-python-to-plot-us-with-50-states
 # (this misses Alaska and Hawaii. If you can get them to work, EXTRA CREDIT)
 
+
 """
 PART 3 DIFFERENCE OF POSITIVE AND NEGATIVE (%Positive - %Negative)
 """
-
-# choose a color for each state based on sentiment.
-diff_colors = {}
-diff_cmap = plt.cm.YlGn
-
-vmin = -1; vmax = 1 # set range.
-
-for shapedict in m.states_info:
-    statename = shapedict['NAME']
-		# skip Puerto Rico and DC
-    if statename not in ['District of Columbia', 'Puerto Rico']:
-        diff = pos_data[statename] - neg_data[statename]
-        diff_colors[statename] = diff_cmap(((( diff - vmin )/( vmax - vmin ))))[:3]
-    statenames.append(statename)
-# cycle through state names, color each one.
-
 # DIFFERENCE MAP
-ax = plt.gca() # get current axes instance
-for nshape, seg in enumerate(m.states):
-		# skip Puerto Rico and DC
-    if statenames[nshape] not in ['District of Columbia', 'Puerto Rico']:
-        color = rgb2hex(diff_colors[statenames[nshape]])
-        poly = Polygon(seg, facecolor=color, edgecolor=color)
-        ax.add_patch(poly)
-plt.title('Difference in Trump Sentiment Across the US')
-plt.savefig("differenceMap.png")
+def plot_difference_map(input_dir, path):
+    pos_data, neg_data = state_sentiment(input_dir)
+    diff_data = dict((state, pos_data[state] - neg_data[state]) for state in pos_data)
+    draw_state_map(diff_data, -1, 1, plt.cm.YlGn, 'Difference in Trump Sentiment Across the US', path)
+
 
 """
 PART 4 SHOULD BE DONE IN SPARK
 """
 
+
+def bin_scores(scores, column, bins_per_decade=BINS_PER_DECADE):
+    """Groups per score sentiment into log spaced score bins, like reddit_model.scoreBins."""
+    values = scores[column].values
+    magnitude = np.floor(np.log10(np.maximum(np.abs(values), 1)) * bins_per_decade) + 1
+    # Without counts (outputs of older runs) every score weighs the same
+    weights = scores['count'].values if 'count' in scores else np.ones(len(scores))
+    binned = pd.DataFrame({
+        'bin': np.where(values == 0, 0, np.sign(values) * magnitude).astype('int64'),
+        'score': values,
+        'positive': scores['Positive'].values * weights,
+        'negative': scores['Negative'].values * weights,
+        'count': weights,
+    }).groupby('bin')
+    result = binned['score'].agg(['min', 'max']).rename(columns={'min': 'score_low', 'max': 'score_high'})
+    totals = binned[['positive', 'negative', 'count']].sum()
+    result['Positive'] = totals['positive'] / totals['count']
+    result['Negative'] = totals['negative'] / totals['count']
+    result['count'] = totals['count']
+    return result.reset_index()
+
+
+def plot_score(input_dir, name, column, xlabel, path):
+    """Plots the positive and negative sentiment of log spaced score bins."""
+    # reddit_model writes the bins, older outputs only have one row per score
+    try:
+        bins = read_output(input_dir, name + '_bins')
+    except IOError:
+        bins = bin_scores(read_output(input_dir, name), column)
+    bins = bins.sort_values('bin')
+    centers = (bins['score_low'].values + bins['score_high'].values) / 2.0
+    # Marker area grows with the log of the comments in the bin
+    sizes = 10 + 10 * np.log10(bins['count'].values.astype(float) + 1)
+
+    fig = plt.figure(figsize=(12,5))
+    ax1 = fig.add_subplot(111)
+
+    ax1.plot(centers, bins['Positive'].values, c='b', lw=1)
+    ax1.plot(centers, bins['Negative'].values, c='r', lw=1)
+    ax1.scatter(centers, bins['Positive'].values, s=sizes, c='b', marker="s", label='Positive')
+    ax1.scatter(centers, bins['Negative'].values, s=sizes, c='r', marker="o", label='Negative')
+    ax1.set_xscale('symlog')
+    ax1.legend(loc='lower right')
+
+    ax1.set_xlabel(xlabel)
+    ax1.set_ylabel("Percent Sentiment")
+    fig.savefig(path)
+    plt.close(fig)
+
+
 """
 PLOT 5A: SENTIMENT BY STORY SCORE
 """
@@ -178,19 +307,9 @@ PLOT 5A: SENTIMENT BY STORY SCORE
 
 # Assumes a CSV file called submission_score.csv with the following coluns
 # submission_score, Positive, Negative
+def plot_story_score(input_dir, path):
+    plot_score(input_dir, 'submission_score', 'submission_score', 'President Trump Sentiment by Submission Score', path)
 
-story = pd.read_csv("submission_score.csv/part-00000-5e23c46a-9186-4347-888a-9ea67db15b0f-c000.csv", engine='python')
-plt.figure(figsize=(12,5))
-fig = plt.figure()
-ax1 = fig.add_subplot(111)
-
-ax1.scatter(story['submission_score'], story['Positive'], s=10, c='b', marker="s", label='Positive')
-ax1.scatter(story['submission_score'], story['Negative'], s=10, c='r', marker="o", label='Negative')
-plt.legend(loc='lower right');
-
-plt.xlabel('President Trump Sentiment by Submission Score')
-plt.ylabel("Percent Sentiment")
-plt.savefig("plot5a.png")
 
 """
 PLOT 5B: SENTIMENT BY COMMENT SCORE
@@ -201,16 +320,95 @@ PLOT 5B: SENTIMENT BY COMMENT SCORE
 
 # Assumes a CSV file called comment_score.csv with the following columns
 # comment_score, Positive, Negative
-
-story = pd.read_csv("comment_score.csv/part-00000-00fe3005-6a63-4a27-b38e-45b099845f46-c000.csv", engine='python')
-plt.figure(figsize=(12,5))
-fig = plt.figure()
-ax1 = fig.add_subplot(111)
-
-ax1.scatter(story['comment_score'], story['Positive'], s=10, c='b', marker="s", label='Positive')
-ax1.scatter(story['comment_score'], story['Negative'], s=10, c='r', marker="o", label='Negative')
-plt.legend(loc='lower right');
-
-plt.xlabel('President Trump Sentiment by Comment Score')
-plt.ylabel("Percent Sentiment")
-plt.savefig("plot5b.png")
+def plot_comment_score(input_dir, path):
+    plot_score(input_dir, 'comment_score', 'comment_score', 'President Trump Sentiment by Comment Score', path)
+
+
+# Every plot: its function, the inputs it reads and the file it writes
+PLOTS = {
+    'part1': (plot_time_series, ['time_data'], "part1.png"),
+    'positiveMap': (plot_positive_map, ['state_data'], "positiveMap.png"),
+    'negativeMap': (plot_negative_map, ['state_data'], "negativeMap.png"),
+    'differenceMap': (plot_difference_map, ['state_data'], "differenceMap.png"),
+    'plot5a': (plot_story_score, ['submission_score', 'submission_score_bins'], "plot5a.png"),
+    'plot5b': (plot_comment_score, ['comment_score', 'comment_score_bins'], "plot5b.png"),
+}
+
+
+def input_hash(input_dir, names):
+    """Hashes the contents of the inputs of a plot."""
+    digest = hashlib.sha1()
+    for name in names:
+        try:
+            parts = output_files(input_dir, name)
+        except IOError:
+            # An optional output, like the score bins of older runs
+            digest.update(name.encode('utf-8'))
+            continue
+        for part in parts:
+            with open(part, 'rb') as saved:
+                digest.update(saved.read())
+    return digest.hexdigest()
+
+
+def render_plot(task):
+    """Renders one plot, returns its name and the hash of its inputs."""
+    name, input_dir, output_dir = task
+    function, inputs, output = PLOTS[name]
+    function(input_dir, os.path.join(output_dir, output))
+    return name, input_hash(input_dir, inputs)
+
+
+def render(names, input_dir='.', output_dir='.', jobs=None, force=False):
+    """Renders the plots whose inputs changed since their last render, in parallel. Returns the rendered names."""
+    state_path = os.path.join(output_dir, RENDER_STATE)
+    try:
+        with open(state_path) as saved:
+            state = json.load(saved)
+    except (IOError, ValueError):
+        state = {}
+    stale = [name for name in names if force
+             or not os.path.exists(os.path.join(output_dir, PLOTS[name][2]))
+             or state.get(name) != input_hash(input_dir, PLOTS[name][1])]
+    if not stale:
+        return []
+
+    tasks = [(name, input_dir, output_dir) for name in stale]
+    if jobs == 1 or len(tasks) == 1:
+        rendered = [render_plot(task) for task in tasks]
+    else:
+        # The plots are independent, each worker process renders its own. maxtasksperchild
+        # is not set, so a worker building the map figure reuses it for the other maps.
+        pool = multiprocessing.Pool(min(jobs or multiprocessing.cpu_count(), len(tasks)))
+        try:
+            rendered = pool.map(render_plot, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    state.update(rendered)
+    with open(state_path, 'w') as saved:
+        json.dump(state, saved, indent=2, sort_keys=True)
+    return [name for name, _ in rendered]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('plots', nargs='*', help="plots to render, all by default: " + ", ".join(sorted(PLOTS)))
+    parser.add_argument('--input-dir', default='.', help="directory with the CSV outputs of reddit_model.py")
+    parser.add_argument('--output-dir', default='.', help="directory the PNG files are written to")
+    parser.add_argument('--jobs', type=int, help="worker processes, one per CPU by default")
+    parser.add_argument('--force', action='store_true', help="render even the plots whose inputs have not changed")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.plots if name not in PLOTS]
+    if unknown:
+        parser.error("unknown plots: " + ", ".join(unknown))
+
+    names = args.plots or sorted(PLOTS)
+    rendered = render(names, args.input_dir, args.output_dir, args.jobs, args.force)
+    for name in names:
+        print("{}: {}".format(name, "rendered" if name in rendered else "up to date"))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,612 @@
+#!/usr/bin/env python3
+
+"""Benchmarks for the Reddit sentiment pipeline."""
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import bz2
+import time
+import json
+import shutil
+import calendar
+import datetime
+import tempfile
+import timeit
+import random
+import pickle
+import tracemalloc
+import resource
+import argparse
+import subprocess
+
+from cleantext import sanitize, sanitize_ids, sanitize_batch, remove_punc, SanitizeCache, _ENDING_PUNC
+
+# Comments covering every branch of the tokenizer: URLs at the start, middle
+# and end of tokens, leading/trailing/inner punctuation, '%', blank tokens,
+# separators other than spaces and non-ASCII text.
+EQUIVALENCE_CORPUS = [
+	"",
+	" ",
+	"\n\t \n",
+	"hello\nhi. my name is justin. I love python!!",
+	"I'm afraid I can't explain myself, sir. Because I am not myself, you see?",
+	"Check out https://www.reddit.com/r/politics/comments/7abc12/ for details",
+	"see:http://example.com/a,b and (www.example.com) or www3.foo.bar",
+	"example.com/page?x=1 sub.example.co.uk/index.html a-b.org/ .foo.com/ -x.io/",
+	"HTTP://UPPER.CASE.COM/PATH Www.Mixed.Case",
+	"!!! ??? ... ,,, ;;; ::: --- ((( )))",
+	"hello !! world ... again",
+	"\"quoted,\" said he; then: 'single' (parens) [brackets] {braces}",
+	"100% of 50%... %%% %a% a%",
+	"__init__ _under_ snake_case_word",
+	"end. of. sentence.",
+	"trailing punctuation?!;: mixed.,",
+	"tabs\tand\nnewlines\r\nand\rcarriage returns",
+	"café naïve é.foo.com/ ’quoted’ “double”",
+	"emoji \U0001F600 text \U0001F600. more",
+	"&gt; quoted reply /s",
+	"trump's approval is at 40% -- maybe 39.5%?",
+	"a b c d e f g",
+	"a. b c. d e f",
+	"one two, three four; five six: seven!",
+	"x.www.example.com y-http://z",
+	"İstanbul K kelvin ſs long s",
+]
+
+_WORDS = ["trump", "the", "president", "is", "a", "great", "bad", "www", "http",
+	"com", "and", "100%", "don't", "u.s.", "e-mail", "_", "café", "x"]
+_PIECES = list("                 \n\t\r.,!?;:'\"()[]-_%/&#@*") + [
+	"http://", "https://", "www.", "www1.", ".com/", ".org/", "reddit.com/r/",
+	"’", "é", "İ"]
+
+
+def legacy_sanitize(text):
+	"""The original per-token implementation, kept as the reference output."""
+	to_be_inserted = []
+	bigrams_list = []
+	trigrams_list = []
+	unigrams_list = []
+	offset = 0
+	text_list = re.split('[ \n\t]+', text.lower())
+	for i in range(len(text_list)):
+		word = re.sub(r'(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:.*))','', text_list[i])
+		word_list = remove_punc(word)
+		text_list[i] = word_list[0]
+		if len(word_list) > 1:
+			to_be_inserted.append((word_list[1:], i+1))
+	for (ilist, index) in to_be_inserted:
+		text_list[index+offset:index+offset] = ilist
+		offset += len(ilist)
+	for i in range(len(text_list) - 1, -1, -1):
+		if not text_list[i]:
+			del text_list[i]
+	for i in range(len(text_list)):
+		if text_list[i] not in _ENDING_PUNC:
+			unigrams_list.append(text_list[i])
+	for i in range(len(text_list) - 1):
+		if text_list[i] not in _ENDING_PUNC and text_list[i + 1] not in _ENDING_PUNC:
+			bigrams_list.append(text_list[i] + '_' + text_list[i + 1])
+	for i in range(len(text_list) - 2):
+		if text_list[i] not in _ENDING_PUNC and text_list[i + 1] not in _ENDING_PUNC and text_list[i + 2] not in _ENDING_PUNC:
+			trigrams_list.append(text_list[i] + '_' + text_list[i + 1] + '_' + text_list[i + 2])
+	return unigrams_list + bigrams_list + trigrams_list
+
+
+def random_comment(rng, length):
+	"""Builds a random comment out of words and punctuation/URL pieces."""
+	parts = []
+	for _ in range(length):
+		if rng.random() < 0.6:
+			parts.append(rng.choice(_WORDS))
+		else:
+			parts.append(rng.choice(_PIECES))
+	return "".join(parts)
+
+
+def random_corpus(count, seed=143):
+	rng = random.Random(seed)
+	return [random_comment(rng, rng.randint(0, 60)) for _ in range(count)]
+
+
+def sentence_comment(rng, length):
+	"""Builds a comment that reads like Reddit text: words, some punctuation, rare URLs."""
+	words = []
+	for _ in range(length):
+		word = rng.choice(_WORDS)
+		roll = rng.random()
+		if roll < 0.1:
+			word += rng.choice(".,!?")
+		elif roll < 0.12:
+			word = "(" + word + ")"
+		elif roll < 0.125:
+			word = "https://www.reddit.com/r/politics/"
+		words.append(word)
+	return " ".join(words)
+
+
+def sentence_corpus(count, seed=143):
+	rng = random.Random(seed)
+	return [sentence_comment(rng, rng.randint(1, 80)) for _ in range(count)]
+
+
+def check_equivalence(corpus):
+	"""Returns the texts where sanitize differs from the reference."""
+	return [text for text in corpus if sanitize(text) != legacy_sanitize(text)]
+
+
+def bench_sanitize(args):
+	comments = sentence_corpus(args.comments, seed=args.seed)
+	corpus = EQUIVALENCE_CORPUS + random_corpus(args.fuzz) + comments
+	mismatches = check_equivalence(corpus)
+	print("equivalence: {} texts, {} mismatches".format(len(corpus), len(mismatches)))
+	for text in mismatches[:10]:
+		print("  mismatch: {!r}".format(text))
+	if mismatches:
+		return 1
+
+	legacy = min(timeit.repeat(lambda: [legacy_sanitize(c) for c in comments], number=1, repeat=args.repeat))
+	current = min(timeit.repeat(lambda: [sanitize(c) for c in comments], number=1, repeat=args.repeat))
+	print("legacy sanitize:  {:.3f}s for {} comments".format(legacy, len(comments)))
+	print("current sanitize: {:.3f}s for {} comments".format(current, len(comments)))
+	print("speedup: {:.2f}x".format(legacy / current))
+
+	# Memory held by the n-grams of every comment, and their pickled size (what a UDF sends)
+	for name, function in [("strings", sanitize), ("ids", sanitize_ids)]:
+		tracemalloc.start()
+		outputs = [function(c) for c in comments]
+		held = tracemalloc.get_traced_memory()[0]
+		tracemalloc.stop()
+		pickled = sum(len(pickle.dumps(output, 2)) for output in outputs)
+		elapsed = min(timeit.repeat(lambda: [function(c) for c in comments], number=1, repeat=args.repeat))
+		print("{:8s} {:.3f}s, {:.0f} bytes held and {:.0f} bytes pickled per comment".format(
+			name, elapsed, held / float(len(comments)), pickled / float(len(comments))))
+		del outputs
+
+	if args.duplicates:
+		# Real dumps repeat "[deleted]", "[removed]", bot boilerplate and copypasta
+		rng = random.Random(args.seed)
+		boilerplate = ["[deleted]", "[removed]"] + comments[:50]
+		duplicated = [rng.choice(boilerplate) if rng.random() < args.duplicates else text for text in comments]
+		caches = []
+		def cached():
+			caches.append(SanitizeCache())
+			return sanitize_batch(duplicated, caches[-1])
+		plain = min(timeit.repeat(lambda: sanitize_batch(duplicated), number=1, repeat=args.repeat))
+		memoized = min(timeit.repeat(cached, number=1, repeat=args.repeat))
+		print("with {:.0%} duplicates: {:.3f}s uncached, {:.3f}s cached, hit rate {:.2%}".format(
+			args.duplicates, plain, memoized, caches[-1].hit_rate()))
+	return 0
+
+
+def spark_context(app):
+	"""Starts a local SQL context with cleantext shipped to the workers."""
+	from pyspark import SparkConf, SparkContext
+	from pyspark.sql import SQLContext
+	sc = SparkContext(conf=SparkConf().setAppName(app).setMaster("local[*]"))
+	sc.addPyFile("cleantext.py")
+	return SQLContext(sc)
+
+
+def bench_features(args):
+	"""Compares the CountVectorizer vocabulary and hashed n-gram feature modes."""
+	from pyspark.ml.classification import LogisticRegression
+	from pyspark.ml.evaluation import BinaryClassificationEvaluator
+	from pyspark.ml.feature import CountVectorizer
+	from reddit_model import featurizer, registerSanitize
+
+	context = spark_context("features benchmark")
+	registerSanitize(context)
+	context.read.json(args.comments).createOrReplaceTempView("comments")
+	context.read.csv(args.labeled).createOrReplaceTempView("labeled")
+
+	for mode in ["vocabulary", "hashed"]:
+		bodyExpr, estimator = featurizer(mode, args.num_features, args.min_df)
+		labeledDF = context.sql("""SELECT
+			comments.id AS id,
+			{} AS body,
+			CASE labeled._c3 WHEN 1 THEN 1 ELSE 0 END AS positive,
+			CASE labeled._c3 WHEN -1 THEN 1 ELSE 0 END AS negative
+		FROM labeled
+		JOIN comments ON labeled._c0 = comments.id
+		""".format(bodyExpr)).cache()
+		labeledDF.count()
+
+		start = time.time()
+		model = estimator.fit(labeledDF)
+		featuresDF = model.transform(labeledDF).cache()
+		featuresDF.count()
+		featurizeTime = time.time() - start
+		if isinstance(estimator, CountVectorizer):
+			dimension = len(model.vocabulary)
+			stateBytes = sum(len(term.encode("utf-8")) for term in model.vocabulary)
+		else:
+			dimension = len(model.kept) if model.kept is not None else model.numFeatures
+			stateBytes = 8 * len(model.kept) if model.kept is not None else 0
+
+		result = {"mode": mode, "featurize_seconds": featurizeTime, "features": dimension, "model_state_bytes": stateBytes}
+		for label in ["positive", "negative"]:
+			train, test = featuresDF.withColumnRenamed("vectors", "features").withColumnRenamed(label, "label") \
+				.randomSplit([0.5, 0.5], seed=args.seed)
+			start = time.time()
+			lrModel = LogisticRegression(labelCol="label", featuresCol="features", maxIter=10, regParam=1.0).fit(train)
+			result[label + "_train_seconds"] = time.time() - start
+			predictions = lrModel.transform(test).cache()
+			result[label + "_auc"] = BinaryClassificationEvaluator().evaluate(predictions)
+			result[label + "_accuracy"] = predictions.filter("prediction = label").count() / float(max(predictions.count(), 1))
+			predictions.unpersist()
+		# Peak RSS so far of this Python driver (KiB on Linux), the JVM and workers are separate processes
+		result["python_driver_max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		featuresDF.unpersist()
+		labeledDF.unpersist()
+		print(json.dumps(result, sort_keys=True))
+	return 0
+
+
+def bench_train(args):
+	"""Compares Spark ML cross-validation with the local SciPy trainer on the labeled comments."""
+	from pyspark.ml.classification import LogisticRegression
+	from pyspark.ml.evaluation import BinaryClassificationEvaluator
+	from pyspark.ml.tuning import CrossValidator, ParamGridBuilder
+	from reddit_model import COMMENTS_SCHEMA, LABELED_SCHEMA, readInput, featurizer, registerSanitize, \
+		labeledComments, localCrossval, thresholdedModel, POS_THRESHOLD, NEG_THRESHOLD
+
+	context = spark_context("training benchmark")
+	registerSanitize(context)
+	readInput(context, args.comments, COMMENTS_SCHEMA).createOrReplaceTempView("comments")
+	context.read.csv(args.labeled, schema=LABELED_SCHEMA).createOrReplaceTempView("labeled")
+	bodyExpr, estimator = featurizer(args.features, args.num_features, args.min_df)
+	labeledDF = labeledComments(context, bodyExpr).cache()
+	vectors = estimator.fit(labeledDF).transform(labeledDF).withColumnRenamed("vectors", "features").cache()
+
+	for label, value, threshold in [("positive", 1, POS_THRESHOLD), ("negative", -1, NEG_THRESHOLD)]:
+		data = vectors.selectExpr("features", "CASE djt WHEN {} THEN 1 ELSE 0 END AS label".format(value))
+		train, test = data.randomSplit([0.5, 0.5], seed=args.seed)
+		train.cache().count()
+		test.cache().count()
+		lr = LogisticRegression(labelCol="label", featuresCol="features", maxIter=10)
+		crossval = CrossValidator(estimator=lr, evaluator=BinaryClassificationEvaluator(),
+			estimatorParamMaps=ParamGridBuilder().addGrid(lr.regParam, [1.0]).build(), numFolds=5)
+		crossval.setParallelism(args.parallelism)
+		result = {"label": label, "train_rows": train.count()}
+		for trainer, fit in [("spark", lambda: crossval.fit(train)),
+				("local", lambda: localCrossval(crossval, train, [1.0], args.parallelism))]:
+			start = time.time()
+			model = fit()
+			result[trainer + "_train_seconds"] = time.time() - start
+			# The held out AUC of the model as reddit_model would score with it
+			result[trainer + "_auc"] = BinaryClassificationEvaluator().evaluate(model.bestModel.transform(test))
+			result[trainer + "_positive_rate"] = thresholdedModel(model, threshold, "decision").transform(test) \
+				.where("decision = 1").count() / float(max(test.count(), 1))
+		train.unpersist()
+		test.unpersist()
+		print(json.dumps(result, sort_keys=True))
+	return 0
+
+
+def replay(source, dropDir, rows, batchRows, rate):
+	"""Copies rows JSON lines of source into dropDir, batchRows per file at rate rows per second."""
+	drops = []
+	opener = bz2.BZ2File if source.endswith(".bz2") else open
+	with opener(source, "rb") as dump:
+		written = 0
+		start = time.time()
+		while written < rows:
+			lines = [line for line, _ in zip(dump, range(min(batchRows, rows - written)))]
+			if not lines:
+				break
+			# Write under a hidden name and rename, so the stream never reads a half written file
+			name = "comments-{:06d}.json".format(len(drops))
+			with open(os.path.join(dropDir, "." + name), "wb") as part:
+				part.writelines(lines)
+			os.rename(os.path.join(dropDir, "." + name), os.path.join(dropDir, name))
+			written += len(lines)
+			drops.append((time.time(), len(lines)))
+			# Keep to the target rate
+			time.sleep(max(0.0, start + written / float(rate) - time.time()))
+	return drops
+
+
+def progressTime(progress):
+	"""Returns the end of a micro-batch as a Unix time."""
+	started = datetime.datetime.strptime(progress["timestamp"][:19], "%Y-%m-%dT%H:%M:%S")
+	return calendar.timegm(started.timetuple()) + float(progress["timestamp"][20:23]) / 1000 \
+		+ progress["durationMs"]["triggerExecution"] / 1000.0
+
+
+def percentile(values, fraction):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(fraction * len(values)))] if values else None
+
+
+def bench_stream(args):
+	"""Replays a comments dump into the streaming scorer at a fixed rate and measures it."""
+	from reddit_model import loadModels, latestModelVersion
+	from reddit_stream import readComments, scoredStream, startQueries
+
+	context = spark_context("streaming benchmark")
+	models = loadModels(args.model_dir, args.model_version or latestModelVersion(args.model_dir))
+	if models is None:
+		print("no saved models in {}, run reddit_model.py first".format(args.model_dir))
+		return 1
+	workDir = tempfile.mkdtemp(prefix="stream-bench-")
+	dropDir = os.path.join(workDir, "drop")
+	os.makedirs(dropDir)
+	try:
+		scored = scoredStream(context, readComments(context, dropDir), models, args.submissions, args.watermark)
+		queries = startQueries(context, scored, "memory", checkpoint=os.path.join(workDir, "checkpoint"), trigger=args.trigger,
+			watermark=args.watermark)
+		drops = replay(args.comments, dropDir, args.rows, args.batch_rows, args.rate)
+		total = sum(count for _, count in drops)
+
+		# Wait for the (first) query to have read every replayed row
+		daily = queries[0]
+		deadline = time.time() + args.timeout
+		while sum(progress["numInputRows"] for progress in daily.recentProgress) < total and time.time() < deadline:
+			time.sleep(0.5)
+		batches = [progress for progress in daily.recentProgress if progress["numInputRows"]]
+		for query in queries:
+			query.stop()
+
+		# A file's latency is from its drop until the end of the first batch started after it
+		latencies = []
+		for dropped, _ in drops:
+			ends = [progressTime(progress) for progress in batches if progressTime(progress) >= dropped]
+			if ends:
+				latencies.append(min(ends) - dropped)
+		processed = sum(progress["numInputRows"] for progress in batches)
+		elapsed = (progressTime(batches[-1]) - drops[0][0]) if batches and drops else None
+		result = {
+			"rows_replayed": total,
+			"rows_processed": processed,
+			"target_rate": args.rate,
+			"throughput_rows_per_second": processed / elapsed if elapsed else None,
+			"batches": len(batches),
+			"batch_seconds_p50": percentile([p["durationMs"]["triggerExecution"] / 1000.0 for p in batches], 0.5),
+			"batch_seconds_p95": percentile([p["durationMs"]["triggerExecution"] / 1000.0 for p in batches], 0.95),
+			"latency_seconds_p50": percentile(latencies, 0.5),
+			"latency_seconds_p95": percentile(latencies, 0.95),
+		}
+		print(json.dumps(result, sort_keys=True))
+	finally:
+		shutil.rmtree(workDir, ignore_errors=True)
+	return 0
+
+
+# Flairs of the generated comments, states are a third of them as in the real dump
+_STATES = ["California", "Texas", "New York", "Florida", "Ohio", "Pennsylvania", "Michigan",
+	"Illinois", "Georgia", "Washington", "Arizona", "Wisconsin", "Iowa", "Alaska", "Vermont"]
+_FLAIRS = ["Europe", "Canada", "Puerto Rico", "flair", "I voted", "\u2605"]
+# The dates covered by the real dump
+_FIRST_UTC = calendar.timegm((2016, 11, 1, 0, 0, 0))
+_LAST_UTC = calendar.timegm((2018, 2, 28, 23, 59, 59))
+
+
+def base36(number):
+	"""Returns number in base 36, the way Reddit writes ids."""
+	digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+	text = ""
+	while True:
+		number, digit = divmod(number, 36)
+		text = digits[digit] + text
+		if not number:
+			return text
+
+
+def reddit_score(rng):
+	"""Returns a long tailed score, mostly small and sometimes negative."""
+	return int(rng.paretovariate(1.2)) - rng.randint(0, 2)
+
+
+def generate_corpus(output, comments, submissions=None, labeled=2000, seed=143):
+	"""Writes comments, submissions and labeled files in the layout reddit_model reads, returns their paths."""
+	rng = random.Random(seed)
+	submissions = submissions or max(10, comments // 50)
+	if not os.path.isdir(output):
+		os.makedirs(output)
+	# The names reddit_model reads by default, without importing it (and Spark)
+	paths = {"comments": os.path.join(output, "comments-minimal.json.bz2"),
+		"submissions": os.path.join(output, "submissions.json.bz2"), "labeled": os.path.join(output, "labeled_data.csv")}
+
+	# Submission ids start where the real t3_ ids are, comment ids where the t1_ ones are
+	submissionIds = [base36(36 ** 5 * 6 + i) for i in range(submissions)]
+	with bz2.BZ2File(paths["submissions"], "wb") as dump:
+		for submissionId in submissionIds:
+			title = sentence_comment(rng, rng.randint(3, 15)).capitalize()
+			dump.write((json.dumps({"id": submissionId, "title": title, "score": reddit_score(rng),
+				"subreddit": "politics"}) + "\n").encode("utf-8"))
+
+	# The labeled comments are spread over the dump, their labels lean on the words in them
+	# so the classifiers have something to learn
+	labeledRows = set(rng.sample(range(comments), min(labeled, comments)))
+	with bz2.BZ2File(paths["comments"], "wb") as dump, open(paths["labeled"], "w") as labels:
+		labels.write("Input.id,labeldem,labelgop,labeldjt\n")
+		for row in range(comments):
+			commentId = base36(36 ** 6 * 2 + row)
+			body = sentence_comment(rng, rng.randint(1, 80))
+			roll = rng.random()
+			if roll < 0.02:
+				body += " /s"
+			elif roll < 0.05:
+				body = "&gt; " + body
+			flair = rng.random()
+			if flair < 0.33:
+				flair = rng.choice(_STATES)
+			elif flair < 0.4:
+				flair = rng.choice(_FLAIRS)
+			else:
+				flair = None
+			dump.write((json.dumps({"id": commentId, "body": body, "link_id": "t3_" + rng.choice(submissionIds),
+				"author_flair_text": flair, "created_utc": rng.randint(_FIRST_UTC, _LAST_UTC),
+				"score": reddit_score(rng), "subreddit": "politics"}) + "\n").encode("utf-8"))
+			if row in labeledRows:
+				words = body.split()
+				djt = 1 if "great" in words and rng.random() < 0.8 else -1 if "bad" in words and rng.random() < 0.8 \
+					else rng.choice([-1, 0, 1])
+				labels.write("{},{},{},{}\n".format(commentId, rng.choice([-1, 0, 1]), rng.choice([-1, 0, 1]), djt))
+	return paths
+
+
+def bench_generate(args):
+	"""Writes a synthetic corpus."""
+	start = time.time()
+	paths = generate_corpus(args.output, args.comments, args.submissions, args.labeled, args.seed)
+	print(json.dumps({"seconds": time.time() - start, "comments": args.comments, "paths": paths}, sort_keys=True))
+	return 0
+
+
+def timed(timings, stage, build):
+	"""Runs build, materializing and caching a returned DataFrame, and records its time and row count."""
+	start = time.time()
+	result = build()
+	rows = None
+	if hasattr(result, "cache"):
+		rows = result.cache().count()
+	timings[stage] = {"seconds": time.time() - start, "rows": rows}
+	return result
+
+
+def git_commit():
+	try:
+		return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+			stderr=subprocess.STDOUT).decode("ascii").strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def bench_pipeline(args):
+	"""Runs reddit_model stage by stage on a corpus, timing every stage, and appends the results."""
+	from reddit_model import COMMENTS_SCHEMA, SUBMISSIONS_SCHEMA, LABELED_SCHEMA, readInput, featurizer, \
+		registerSanitize, labeledComments, scoringComments, trainModels, classify, aggregatePartials, sentimentOutputs, writeOutputs
+
+	workDir = tempfile.mkdtemp(prefix="pipeline-bench-")
+	timings = {}
+	try:
+		if args.generate:
+			paths = timed(timings, "generate", lambda: generate_corpus(os.path.join(workDir, "corpus"),
+				args.generate, labeled=args.labeled, seed=args.seed))
+		else:
+			paths = {"comments": args.comments, "submissions": args.submissions, "labeled": args.labeled_file}
+
+		context = spark_context("pipeline benchmark")
+		registerSanitize(context)
+		bodyExpr, cv = featurizer(args.features, args.num_features, args.min_df)
+
+		# Every stage is cached and counted before the next starts, so each one is timed on its own
+		for view, read in [
+				("comments", lambda: readInput(context, paths["comments"], COMMENTS_SCHEMA)),
+				("submissions", lambda: readInput(context, paths["submissions"], SUBMISSIONS_SCHEMA)),
+				("labeled", lambda: context.read.csv(paths["labeled"], schema=LABELED_SCHEMA))]:
+			timed(timings, "ingest_" + view, read).createOrReplaceTempView(view)
+		labeledDF = timed(timings, "sanitize_labeled", lambda: labeledComments(context, bodyExpr))
+		scoringDF = timed(timings, "sanitize_scoring", lambda: scoringComments(context, bodyExpr))
+		cv_model = timed(timings, "featurize_fit", lambda: cv.fit(labeledDF))
+		vectorsDF = timed(timings, "featurize_transform", lambda: cv_model.transform(scoringDF))
+		models = timed(timings, "train", lambda: trainModels(context, cv_model, labeledDF, None, None, args.tuning, args.parallelism))
+		probTable = timed(timings, "score", lambda: classify(context, vectorsDF, models[1], models[2]))
+		partials = timed(timings, "aggregate", lambda: aggregatePartials(context, probTable))
+		outputDir = os.path.join(workDir, "output")
+		timed(timings, "write", lambda: writeOutputs(sentimentOutputs(partials), outputDir))
+
+		if not args.no_render:
+			render = lambda: subprocess.call([sys.executable, "analysis.py", "--force", "--input-dir", outputDir,
+				"--output-dir", outputDir],
+				cwd=os.path.dirname(os.path.abspath(__file__)))
+			returncode = timed(timings, "render", render)
+			timings["render"]["returncode"] = returncode
+
+		result = {
+			"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+			"commit": git_commit(),
+			"spark": context.sparkSession.version,
+			"features": args.features,
+			"tuning": args.tuning,
+			"comments": timings["ingest_comments"]["rows"],
+			"stages": timings,
+			"total_seconds": sum(stage["seconds"] for name, stage in timings.items() if name != "generate"),
+		}
+		line = json.dumps(result, sort_keys=True)
+		print(line)
+		with open(args.results, "a") as results:
+			results.write(line + "\n")
+	finally:
+		shutil.rmtree(workDir, ignore_errors=True)
+	return 0
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__)
+	subparsers = parser.add_subparsers(dest="command")
+	subparsers.required = True
+
+	sanitize_parser = subparsers.add_parser("sanitize", help="check and time cleantext.sanitize")
+	sanitize_parser.add_argument("--comments", type=int, default=20000)
+	sanitize_parser.add_argument("--fuzz", type=int, default=20000, help="random texts added to the equivalence corpus")
+	sanitize_parser.add_argument("--repeat", type=int, default=3)
+	sanitize_parser.add_argument("--seed", type=int, default=2018)
+	sanitize_parser.add_argument("--duplicates", type=float, default=0.3, help="fraction of duplicate bodies for the cache timing, 0 skips it")
+	sanitize_parser.set_defaults(func=bench_sanitize)
+
+	features_parser = subparsers.add_parser("features", help="compare vocabulary and hashed feature modes (needs Spark)")
+	features_parser.add_argument("--comments", default="comments-minimal.json.bz2")
+	features_parser.add_argument("--labeled", default="labeled_data.csv")
+	features_parser.add_argument("--num-features", type=int, default=1 << 18)
+	features_parser.add_argument("--min-df", type=float, default=10.0)
+	features_parser.add_argument("--seed", type=int, default=2018)
+	features_parser.set_defaults(func=bench_features)
+
+	train_parser = subparsers.add_parser("train", help="compare Spark ML and local SciPy training (needs Spark and SciPy)")
+	train_parser.add_argument("--comments", default="comments-minimal.json.bz2")
+	train_parser.add_argument("--labeled", default="labeled_data.csv")
+	train_parser.add_argument("--features", default="vocabulary", choices=["vocabulary", "hashed"])
+	train_parser.add_argument("--num-features", type=int, default=1 << 18)
+	train_parser.add_argument("--min-df", type=float, default=10.0)
+	train_parser.add_argument("--parallelism", type=int, default=1)
+	train_parser.add_argument("--seed", type=int, default=2018)
+	train_parser.set_defaults(func=bench_train)
+
+	stream_parser = subparsers.add_parser("stream", help="replay a dump into reddit_stream at a fixed rate (needs Spark)")
+	stream_parser.add_argument("--comments", default="comments-minimal.json.bz2")
+	stream_parser.add_argument("--submissions", default="submissions.json.bz2")
+	stream_parser.add_argument("--model-dir", default="project2")
+	stream_parser.add_argument("--model-version")
+	stream_parser.add_argument("--rows", type=int, default=100000, help="comments to replay")
+	stream_parser.add_argument("--rate", type=float, default=1000.0, help="comments per second")
+	stream_parser.add_argument("--batch-rows", type=int, default=1000, help="comments per dropped file")
+	stream_parser.add_argument("--trigger", default="2 seconds")
+	stream_parser.add_argument("--watermark", default="1 day")
+	stream_parser.add_argument("--timeout", type=float, default=300.0, help="seconds to wait for the stream to catch up")
+	stream_parser.set_defaults(func=bench_stream)
+
+	generate_parser = subparsers.add_parser("generate", help="write a synthetic comments, submissions and labeled corpus")
+	generate_parser.add_argument("--output", default="synthetic")
+	generate_parser.add_argument("--comments", type=int, default=10000, help="10k to 10M")
+	generate_parser.add_argument("--submissions", type=int, help="comments / 50 by default")
+	generate_parser.add_argument("--labeled", type=int, default=2000)
+	generate_parser.add_argument("--seed", type=int, default=143)
+	generate_parser.set_defaults(func=bench_generate)
+
+	pipeline_parser = subparsers.add_parser("pipeline", help="time every stage of reddit_model end to end (needs Spark)")
+	pipeline_parser.add_argument("--generate", type=int, metavar="COMMENTS", help="run on a fresh synthetic corpus of this size")
+	pipeline_parser.add_argument("--comments", default="comments-minimal.json.bz2")
+	pipeline_parser.add_argument("--submissions", default="submissions.json.bz2")
+	pipeline_parser.add_argument("--labeled-file", default="labeled_data.csv")
+	pipeline_parser.add_argument("--labeled", type=int, default=2000, help="labeled comments of a generated corpus")
+	pipeline_parser.add_argument("--features", default="vocabulary", choices=["vocabulary", "hashed"])
+	pipeline_parser.add_argument("--num-features", type=int, default=1 << 18)
+	pipeline_parser.add_argument("--min-df", type=float, default=10.0)
+	pipeline_parser.add_argument("--tuning", default="fixed", choices=["fixed", "halving"])
+	pipeline_parser.add_argument("--parallelism", type=int, default=1)
+	pipeline_parser.add_argument("--no-render", action="store_true", help="skip timing analysis.py")
+	pipeline_parser.add_argument("--results", default="benchmark_results.jsonl", help="JSON lines file the run is appended to")
+	pipeline_parser.add_argument("--seed", type=int, default=143)
+	pipeline_parser.set_defaults(func=bench_pipeline)
+
+	args = parser.parse_args(argv)
+	return args.func(args)
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -5,8 +5,12 @@
 from __future__ import print_function
 
 import re
+import zlib
 import string
+import array
+import hashlib
 import argparse
+import collections
 
 __author__ = ""
 __email__ = ""
@@ -127,58 +131,178 @@ def remove_punc(token):
 			jdone = True
 	return [""] if i > j else [token[i:(j+1)]] + ending_punc_list
 
+# Compiled once at import. A URL runs from its start to the end of its token,
+# exactly what the old per-token re.sub removed, so one sub over the whole text
+# strips every URL before the text is split into tokens.
+_URL_SCANNER = re.compile(r'(?i)\b(?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)[^ \n\t]*')
+_SEPARATORS = re.compile('[ \n\t]+')
+# Characters stripped from the start/end of a token, see remove_punc.
+_STRIP_CHARS = string.punctuation.replace('%', '')
+
+def _runs(text):
+	"""Returns the words of text, with None wherever ending punctuation breaks the run of n-grams."""
+	words = []
+	text = text.lower()
+	# Every URL has a '/' or starts with www, skip the scan when neither is there
+	if '/' in text or 'www' in text:
+		text = _URL_SCANNER.sub('', text)
+
+	for word in _SEPARATORS.split(text):
+		# Same as remove_punc: strip punctuation, an all punctuation token is dropped
+		# together with its ending punctuation
+		core = word.strip(_STRIP_CHARS)
+		if not core:
+			continue
+		words.append(core)
+		# Ending punctuation after the word starts a new run
+		if word[-1] != core[-1] and not _ENDING_PUNC.isdisjoint(word[len(word.rstrip(_STRIP_CHARS)):]):
+			words.append(None)
+	return words
+
 def sanitize(text):
-	# A list to keep track of all ending punctuations and where to insert these punctuations
-	to_be_inserted = []
-	# List to keep track of bigrams and trigrams, to be joined later
+	"""Returns the unigrams, bigrams and trigrams of text in one pass."""
+	unigrams_list = []
 	bigrams_list = []
 	trigrams_list = []
-	unigrams_list = []
-	offset = 0
-	
-	# Combine steps 1 and 5 by splitting by tabs, spaces, and newline characters, while lowercasing the string
-	text_list = re.split('[ \n\t]+', text.lower())
-
-	for i in range(len(text_list)):
-		# Remove URL's
-		word = re.sub(r'(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:.*))','', text_list[i])
-
-		# Remove punctuation and save the ending punctuation in a list to be added after
-		word_list = remove_punc(word)
-		text_list[i] = word_list[0]
-		if len(word_list) > 1:
-			to_be_inserted.append((word_list[1:], i+1))
-	
-	# Insert ending punctuation to the text list for the parsed text
-	for (ilist, index) in to_be_inserted:
-		text_list[index+offset:index+offset] = ilist
-		offset += len(ilist)
-		
-	# Filter out any blank elements
-	for i in range(len(text_list) - 1, -1, -1):
-		word = text_list[i]
-		if not word:
-			del text_list[i]
-
-	# Create unigrams
-	for i in range(len(text_list)):
-		if text_list[i] not in _ENDING_PUNC:
-			unigram = text_list[i]
-			unigrams_list.append(unigram)
-	
-	# Create bigrams
-	for i in range(len(text_list) - 1):
-		if text_list[i] not in _ENDING_PUNC and text_list[i + 1] not in _ENDING_PUNC:
-			bigram = text_list[i] + '_' + text_list[i + 1]
+	# The last two words of the current run
+	prev1 = prev2 = None
+
+	for core in _runs(text):
+		if core is None:
+			prev1 = prev2 = None
+			continue
+		unigrams_list.append(core)
+		if prev1 is not None:
+			bigram = prev1 + '_' + core
 			bigrams_list.append(bigram)
-		
-	# Create trigrams
-	for i in range(len(text_list) - 2):
-		if text_list[i] not in _ENDING_PUNC and text_list[i + 1] not in _ENDING_PUNC and text_list[i + 2] not in _ENDING_PUNC:
-			trigram = text_list[i] + '_' + text_list[i + 1] + '_' + text_list[i + 2]
-			trigrams_list.append(trigram)
-	
-	return unigrams_list + bigrams_list + trigrams_list
+			if prev2 is not None:
+				trigrams_list.append(prev2 + '_' + bigram)
+		prev2 = prev1
+		prev1 = core
+
+	unigrams_list.extend(bigrams_list)
+	unigrams_list.extend(trigrams_list)
+	return unigrams_list
+
+# Ids are 31 bit so they fit a signed 32 bit int in Arrow and the JVM
+_ID_MASK = 0x7fffffff
+
+def _ngram_id(prefix_id, word_id):
+	# An n-gram is the tuple of its word ids, folded left like prefix + '_' + word
+	return (prefix_id * 1000003 ^ word_id) & _ID_MASK
+
+def sanitize_ids(text):
+	"""Returns the n-grams of text like sanitize, as stable integer ids in a compact int array."""
+	# The same order as sanitize: unigrams, then bigrams, then trigrams. A word's id is the
+	# crc32 of it, so every process agrees, and no bigram or trigram string is ever built.
+	unigrams = array.array('i')
+	bigrams = array.array('i')
+	trigrams = array.array('i')
+	prev1 = prev2 = bigram_id = None
+	crc32 = zlib.crc32
+
+	for core in _runs(text):
+		if core is None:
+			prev1 = prev2 = None
+			continue
+		word_id = crc32(core.encode('utf-8')) & _ID_MASK
+		unigrams.append(word_id)
+		if prev1 is not None:
+			# _ngram_id inlined, this is the hot loop
+			if prev2 is not None:
+				trigrams.append((bigram_id * 1000003 ^ word_id) & _ID_MASK)
+			# Also the prefix of the next trigram
+			bigram_id = (prev1 * 1000003 ^ word_id) & _ID_MASK
+			bigrams.append(bigram_id)
+		prev2 = prev1
+		prev1 = word_id
+
+	unigrams.extend(bigrams)
+	unigrams.extend(trigrams)
+	return unigrams
+
+def sanitize_ids_batch(texts, cache=None):
+	"""Returns sanitize_ids of a batch of texts, a pandas Series gives back a Series of int32 NumPy arrays."""
+	run = sanitize_ids if cache is None else cache.sanitize
+	results = [None if text is None else run(text) for text in texts]
+	if type(texts).__module__.startswith('pandas'):
+		import numpy as np
+		import pandas as pd
+		# frombuffer shares the array's memory, no per-element copy
+		return pd.Series([None if ids is None else np.frombuffer(ids, dtype=np.int32) for ids in results], index=texts.index)
+	return results
+
+class SanitizeCache(object):
+	"""A bounded LRU cache of sanitize (or sanitize_ids) results, keyed by a hash of the text."""
+
+	def __init__(self, max_entries=100000, max_bytes=64 << 20, function=sanitize):
+		self.function = function
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self._entries = collections.OrderedDict()
+
+	def sanitize(self, text):
+		# A 16 byte digest instead of the text, long copypasta is not kept twice
+		key = hashlib.md5(text.encode('utf-8')).digest()
+		entries = self._entries
+		if key in entries:
+			self.hits += 1
+			# Move to the most recently used end
+			ngrams = entries.pop(key)
+			entries[key] = ngrams
+			# A copy, the caller may change what it is given
+			return ngrams[:]
+		self.misses += 1
+		ngrams = self.function(text)
+		entries[key] = ngrams
+		self.bytes += _entry_size(ngrams)
+		while entries and (len(entries) > self.max_entries or self.bytes > self.max_bytes):
+			self.bytes -= _entry_size(entries.popitem(last=False)[1])
+		return ngrams[:]
+
+	def hit_rate(self):
+		lookups = self.hits + self.misses
+		return self.hits / float(lookups) if lookups else 0.0
+
+	def stats(self):
+		return {'entries': len(self._entries), 'bytes': self.bytes, 'hits': self.hits,
+			'misses': self.misses, 'hit_rate': self.hit_rate()}
+
+def _entry_size(ngrams):
+	# Roughly what CPython holds for the key, the list and its strings, or the id array
+	if isinstance(ngrams, array.array):
+		return 120 + ngrams.itemsize * len(ngrams)
+	return 120 + sum(57 + len(ngram) for ngram in ngrams)
+
+_shared_caches = {}
+
+def shared_cache(max_entries=100000, max_bytes=64 << 20, function=sanitize):
+	"""Returns this process's cache of function, made on the first call, so a Spark worker reuses it across batches."""
+	if function not in _shared_caches:
+		_shared_caches[function] = SanitizeCache(max_entries, max_bytes, function)
+	return _shared_caches[function]
+
+def sanitize_batch(texts, cache=None):
+	"""Sanitizes a whole batch of texts, a pandas Series gives back a Series."""
+	run = sanitize if cache is None else cache.sanitize
+	results = [None if text is None else run(text) for text in texts]
+	# pandas is only needed when we were handed a Series (e.g. from a pandas_udf)
+	if type(texts).__module__.startswith('pandas'):
+		import pandas as pd
+		return pd.Series(results, index=texts.index)
+	return results
+
+def hash_ids(ids, num_features):
+	"""Returns the sorted, distinct hashed indices of n-gram ids."""
+	return sorted(set(ngram_id % num_features for ngram_id in ids))
+
+def hash_ngrams(text, num_features):
+	"""Returns the sorted, distinct hashed indices of the n-grams of text."""
+	# crc32 based ids rather than hash() so every worker process agrees on the indices
+	return hash_ids(sanitize_ids(text), num_features)
 
 
 if __name__ == "__main__":
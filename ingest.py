@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+"""Convert the Reddit bz2 dumps once into projected, compressed Parquet."""
+
+from __future__ import print_function
+
+import os
+import argparse
+from pyspark import SparkConf, SparkContext
+from pyspark.sql import SQLContext
+from reddit_model import COMMENTS, SUBMISSIONS, COMMENTS_SCHEMA, SUBMISSIONS_SCHEMA
+
+def ingest(context, source, schema, destination, chunks, compression):
+	"""Reads a JSON dump with only the schema's columns and writes it as chunks Parquet files."""
+	df = context.read.json(source, schema=schema)
+	# A bz2 stream is read by few tasks, spreading it over many files lets every core
+	# work on the Parquet copy
+	df.repartition(chunks).write.mode("overwrite").option("compression", compression).parquet(destination)
+	print("Wrote {} to {}".format(source, destination))
+
+def main(context, args):
+	ingest(context, args.comments, COMMENTS_SCHEMA, os.path.join(args.output, "comments.parquet"), args.chunks, args.compression)
+	ingest(context, args.submissions, SUBMISSIONS_SCHEMA, os.path.join(args.output, "submissions.parquet"), args.chunks, args.compression)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument("--comments", default=COMMENTS)
+	parser.add_argument("--submissions", default=SUBMISSIONS)
+	parser.add_argument("--output", default="ingested", help="directory for comments.parquet and submissions.parquet")
+	parser.add_argument("--chunks", type=int, default=64, help="number of Parquet files per dump")
+	parser.add_argument("--compression", default="snappy", choices=["snappy", "gzip", "none"])
+	args = parser.parse_args()
+
+	conf = SparkConf().setAppName("CS143 Project 2B ingest")
+	conf = conf.setMaster("local[*]")
+	sc   = SparkContext(conf=conf)
+	sqlContext = SQLContext(sc)
+	main(sqlContext, args)
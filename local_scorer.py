@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+"""Score comments without Spark, using models exported from the saved Spark models."""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import math
+import argparse
+import numpy as np
+from cleantext import sanitize, hash_ngrams
+
+# Files of an exported model directory
+META = "meta.json"
+VOCABULARY = "vocabulary.txt"
+POS_COEFFICIENTS = "pos_coefficients.npy"
+NEG_COEFFICIENTS = "neg_coefficients.npy"
+GOLDEN = "golden.jsonl"
+
+class LocalScorer(object):
+	"""The vectorizer and both logistic regressions of a trained model, in plain Python and NumPy."""
+
+	def __init__(self, meta, vocabulary, posCoefficients, negCoefficients):
+		self.meta = meta
+		self.vocabulary = vocabulary
+		self.posCoefficients = posCoefficients
+		self.negCoefficients = negCoefficients
+		self.kept = frozenset(meta["kept"]) if meta.get("kept") is not None else None
+
+	@classmethod
+	def load(cls, path):
+		"""Loads an exported model, the coefficient arrays are memory mapped rather than read."""
+		with open(os.path.join(path, META)) as saved:
+			meta = json.load(saved)
+		vocabulary = None
+		if meta["features"] == "vocabulary":
+			with open(os.path.join(path, VOCABULARY), "rb") as saved:
+				terms = saved.read().decode("utf-8").split("\n")
+			vocabulary = dict(zip(terms, range(len(terms))))
+		posCoefficients = np.load(os.path.join(path, POS_COEFFICIENTS), mmap_mode="r")
+		negCoefficients = np.load(os.path.join(path, NEG_COEFFICIENTS), mmap_mode="r")
+		return cls(meta, vocabulary, posCoefficients, negCoefficients)
+
+	def indices(self, text):
+		"""Returns the sorted indices of the features set for text, as the Spark vectorizer would."""
+		if self.vocabulary is None:
+			indices = hash_ngrams(text, self.meta["numFeatures"])
+			if self.kept is not None:
+				indices = [index for index in indices if index in self.kept]
+			return indices
+		vocabulary = self.vocabulary
+		return sorted(set(vocabulary[ngram] for ngram in sanitize(text) if ngram in vocabulary))
+
+	def probabilities(self, text):
+		"""Returns the positive and negative probabilities of text."""
+		indices = self.indices(text)
+		return (self._probability(self.posCoefficients, self.meta["posIntercept"], indices),
+			self._probability(self.negCoefficients, self.meta["negIntercept"], indices))
+
+	def score(self, text):
+		"""Returns (pos, neg) as 1/0 using the thresholds of reddit_model."""
+		pos, neg = self.probabilities(text)
+		return int(pos > self.meta["posThreshold"]), int(neg > self.meta["negThreshold"])
+
+	def score_batch(self, texts):
+		return [self.score(text) for text in texts]
+
+	@staticmethod
+	def _probability(coefficients, intercept, indices):
+		# The same sum in the same order as Spark's sparse dot product, cumsum adds left to right
+		margin = float(np.cumsum(coefficients[indices])[-1]) if indices else 0.0
+		return 1.0 / (1.0 + math.exp(-(margin + intercept)))
+
+
+def export(context, modelDir, version, output, golden=None, goldenSize=1000):
+	"""Writes the saved Spark models of a version as a LocalScorer model, optionally with a golden set."""
+	from reddit_model import loadModels, latestModelVersion, POS_THRESHOLD, NEG_THRESHOLD
+	version = version or latestModelVersion(modelDir)
+	models = loadModels(modelDir, version)
+	if models is None:
+		raise ValueError("No trained models of version {} in {}".format(version, modelDir))
+	features, cv_model, posModel, negModel = models
+	if not os.path.isdir(output):
+		os.makedirs(output)
+
+	meta = {
+		"version": version,
+		"features": features,
+		"posIntercept": posModel.bestModel.intercept,
+		"negIntercept": negModel.bestModel.intercept,
+		"posThreshold": POS_THRESHOLD,
+		"negThreshold": NEG_THRESHOLD,
+	}
+	if features == "hashed":
+		meta["numFeatures"] = cv_model.numFeatures
+		meta["kept"] = sorted(cv_model.kept) if cv_model.kept is not None else None
+	else:
+		# n-grams never contain a newline, sanitize splits on them
+		with open(os.path.join(output, VOCABULARY), "wb") as saved:
+			saved.write("\n".join(cv_model.vocabulary).encode("utf-8"))
+	np.save(os.path.join(output, POS_COEFFICIENTS), posModel.bestModel.coefficients.toArray())
+	np.save(os.path.join(output, NEG_COEFFICIENTS), negModel.bestModel.coefficients.toArray())
+	with open(os.path.join(output, META), "w") as saved:
+		json.dump(meta, saved)
+
+	if golden:
+		writeGolden(context, models, golden, goldenSize, os.path.join(output, GOLDEN))
+
+def writeGolden(context, models, comments, size, path):
+	"""Scores size comments with the Spark models and saves their texts and probabilities."""
+	from reddit_model import COMMENTS_SCHEMA, readInput, registerSanitize, featurizer
+	features, cv_model, posModel, negModel = models
+	registerSanitize(context)
+	readInput(context, comments, COMMENTS_SCHEMA).where("body IS NOT NULL").limit(size) \
+		.createOrReplaceTempView("comments")
+	bodies = context.sql("SELECT comments.body AS text, {} AS body FROM comments".format(featurizer(features)[0]))
+	vectors = cv_model.transform(bodies).withColumnRenamed("vectors", "features")
+	posResult = posModel.bestModel.transform(vectors) \
+		.selectExpr("text", "features", "probability AS pos_probability")
+	rows = negModel.bestModel.transform(posResult).select("text", "pos_probability", "probability").collect()
+	with open(path, "w") as saved:
+		for row in rows:
+			saved.write(json.dumps({"text": row.text, "pos": row.pos_probability[1], "neg": row.probability[1]}) + "\n")
+
+def verify(scorer, path, tolerance=1e-12):
+	"""Compares the scorer with the Spark probabilities of a golden set, returns the mismatching texts."""
+	mismatches = []
+	with open(path) as golden:
+		for line in golden:
+			expected = json.loads(line)
+			pos, neg = scorer.probabilities(expected["text"])
+			# The JVM's exp may differ from C's in the last bit, so allow for that, but the
+			# 1/0 decisions have to agree exactly
+			decisions = (int(expected["pos"] > scorer.meta["posThreshold"]), int(expected["neg"] > scorer.meta["negThreshold"]))
+			if abs(pos - expected["pos"]) > tolerance or abs(neg - expected["neg"]) > tolerance \
+					or scorer.score(expected["text"]) != decisions:
+				mismatches.append(expected["text"])
+	return mismatches
+
+def readTexts(paths, jsonField=None):
+	"""Yields one text per line of the files (stdin when none), or one field of JSON lines."""
+	for path in paths or ["-"]:
+		lines = sys.stdin if path == "-" else open(path)
+		try:
+			for line in lines:
+				line = line.rstrip("\n")
+				yield json.loads(line)[jsonField] if jsonField else line
+		finally:
+			if lines is not sys.stdin:
+				lines.close()
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__)
+	subparsers = parser.add_subparsers(dest="command")
+	subparsers.required = True
+
+	export_parser = subparsers.add_parser("export", help="export saved Spark models (needs Spark)")
+	export_parser.add_argument("--model-dir", default="project2")
+	export_parser.add_argument("--model-version", help="the latest saved version by default")
+	export_parser.add_argument("--output", default="local_model")
+	export_parser.add_argument("--golden", help="comments dump to take a golden set from")
+	export_parser.add_argument("--golden-size", type=int, default=1000)
+
+	score_parser = subparsers.add_parser("score", help="score texts, one per line, printing pos and neg")
+	score_parser.add_argument("files", nargs="*", help="files to score, stdin by default")
+	score_parser.add_argument("--model", default="local_model")
+	score_parser.add_argument("--json-field", help="read JSON lines and score this field, e.g. body")
+	score_parser.add_argument("--probabilities", action="store_true", help="print probabilities instead of 1/0")
+
+	verify_parser = subparsers.add_parser("verify", help="check the scorer against the exported golden set")
+	verify_parser.add_argument("--model", default="local_model")
+
+	args = parser.parse_args(argv)
+	if args.command == "export":
+		from pyspark import SparkConf, SparkContext
+		from pyspark.sql import SQLContext
+		sc = SparkContext(conf=SparkConf().setAppName("CS143 Project 2B export").setMaster("local[*]"))
+		sc.addPyFile("cleantext.py")
+		export(SQLContext(sc), args.model_dir, args.model_version, args.output, args.golden, args.golden_size)
+		return 0
+
+	scorer = LocalScorer.load(args.model)
+	if args.command == "verify":
+		mismatches = verify(scorer, os.path.join(args.model, GOLDEN))
+		print("{} mismatches".format(len(mismatches)))
+		return 1 if mismatches else 0
+	for text in readTexts(args.files, args.json_field):
+		result = scorer.probabilities(text) if args.probabilities else scorer.score(text)
+		print("{}\t{}".format(*result))
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
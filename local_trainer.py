@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+"""Fit the logistic regressions of reddit_model on one machine, for labeled sets small enough to collect."""
+
+from __future__ import print_function
+
+import numpy as np
+import scipy.sparse
+import scipy.optimize
+import multiprocessing
+
+def to_csr(rows, num_features):
+	"""Builds a CSR matrix and a label array from collected (features, label) rows of Spark vectors."""
+	indptr = [0]
+	indices = []
+	values = []
+	labels = []
+	for features, label in rows:
+		# CountVectorizer and HashedNgrams give sparse vectors, anything else is made dense
+		vector = features if hasattr(features, "indices") else features.toSparse()
+		indices.extend(vector.indices)
+		values.extend(vector.values)
+		indptr.append(len(indices))
+		labels.append(label)
+	matrix = scipy.sparse.csr_matrix((np.asarray(values, dtype=np.float64), np.asarray(indices, dtype=np.int32),
+		np.asarray(indptr, dtype=np.int64)), shape=(len(labels), num_features))
+	return matrix, np.asarray(labels, dtype=np.float64)
+
+def feature_std(X):
+	"""Returns the sample standard deviation of every column, like Spark's summarizer."""
+	n = X.shape[0]
+	if n < 2:
+		return np.zeros(X.shape[1])
+	mean = np.asarray(X.mean(axis=0)).ravel()
+	squares = np.asarray(X.multiply(X).mean(axis=0)).ravel()
+	return np.sqrt(np.maximum(squares - mean * mean, 0.0) * n / (n - 1))
+
+def fit_logistic(X, y, reg_param, max_iter=100, tol=1e-6):
+	"""Fits L2 regularized logistic regression the way Spark's does with standardization on.
+
+	Returns (coefficients, intercept). The loss is the mean log loss plus
+	reg_param / 2 * sum((w * std) ** 2), the intercept is not regularized and features
+	that never vary get a zero coefficient.
+	"""
+	n, d = X.shape
+	std = feature_std(X)
+	penalty = reg_param * std * std
+	varying = std > 0
+
+	def loss(theta):
+		w, b = theta[:d], theta[d]
+		margin = X.dot(w) + b
+		# log(1 + exp(m)) - y m, stable for large |m|
+		value = np.mean(np.logaddexp(0.0, margin) - y * margin) + 0.5 * np.dot(penalty, w * w)
+		error = (1.0 / (1.0 + np.exp(-margin)) - y) / n
+		gradient = np.empty(d + 1)
+		gradient[:d] = X.T.dot(error) + penalty * w
+		gradient[:d][~varying] = 0.0
+		gradient[d] = error.sum()
+		return value, gradient
+
+	result = scipy.optimize.minimize(loss, np.zeros(d + 1), jac=True, method="L-BFGS-B",
+		options={"maxiter": max_iter, "gtol": tol})
+	return result.x[:d], float(result.x[d])
+
+def auc(labels, scores):
+	"""Area under the ROC curve, ties counted as half, like BinaryClassificationEvaluator."""
+	positives = labels.sum()
+	negatives = len(labels) - positives
+	if not positives or not negatives:
+		return 0.5
+	# Mann-Whitney U from the average ranks of the scores
+	order = np.argsort(scores, kind="mergesort")
+	ranks = np.empty(len(scores))
+	sorted_scores = scores[order]
+	starts = np.r_[0, np.flatnonzero(np.diff(sorted_scores)) + 1]
+	ends = np.r_[starts[1:], len(scores)]
+	for start, end in zip(starts, ends):
+		ranks[order[start:end]] = (start + end + 1) / 2.0
+	return (ranks[labels == 1].sum() - positives * (positives + 1) / 2.0) / (positives * negatives)
+
+# The data of a spawned pool worker, set once by _init_worker so the tasks only carry a fold
+# and a regParam. Only the pool workers use it, the serial path may run in several threads.
+_data = None
+
+def _init_worker(X, y, folds):
+	global _data
+	_data = (X, y, folds)
+
+def _fit_worker_fold(task):
+	return _fit_fold(_data, task)
+
+def _fit_fold(data, task):
+	fold, reg_param, max_iter = task
+	X, y, folds = data
+	train = np.flatnonzero(folds != fold)
+	validation = np.flatnonzero(folds == fold)
+	w, b = fit_logistic(X[train], y[train], reg_param, max_iter)
+	return auc(y[validation], X[validation].dot(w) + b)
+
+def cross_validate(X, y, reg_params, num_folds=5, processes=1, max_iter=100, seed=0):
+	"""Picks the regParam with the best mean validation AUC and refits on everything.
+
+	Returns (coefficients, intercept, best reg_param, mean AUC of every reg_param).
+	"""
+	folds = np.random.RandomState(seed).randint(0, num_folds, X.shape[0])
+	tasks = [(fold, reg_param, max_iter) for reg_param in reg_params for fold in range(num_folds)]
+	if processes > 1:
+		# Every grid point and fold is an independent fit. The workers are spawned, not forked:
+		# reddit_model calls this from threads while others may hold py4j locks. X and y are
+		# sent once per worker rather than once per task.
+		pool = multiprocessing.get_context("spawn").Pool(processes, _init_worker, (X, y, folds))
+		try:
+			metrics = pool.map(_fit_worker_fold, tasks)
+		finally:
+			pool.close()
+			pool.join()
+	else:
+		metrics = [_fit_fold((X, y, folds), task) for task in tasks]
+	avg_metrics = [float(np.mean(metrics[i * num_folds:(i + 1) * num_folds])) for i in range(len(reg_params))]
+	best = reg_params[int(np.argmax(avg_metrics))]
+	w, b = fit_logistic(X, y, best, max_iter)
+	return w, b, best, avg_metrics
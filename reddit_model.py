@@ -1,71 +1,324 @@
 from __future__ import print_function
+import os
+import json
+import time
+import calendar
+import datetime
+import shutil
+import argparse
+import hashlib
+import inspect
+import cleantext
+from operator import add
+from multiprocessing.pool import ThreadPool
+try:
+	from urllib.request import urlopen
+except ImportError:
+	from urllib2 import urlopen
 from pyspark import SparkConf, SparkContext
 from pyspark.sql import SQLContext
-from pyspark.sql.types import ArrayType, StringType
-from cleantext import sanitize
-from pyspark.ml.feature import CountVectorizer
-from pyspark.ml.classification import LogisticRegression
+from pyspark.sql.types import ArrayType, StringType, IntegerType, DoubleType, StructType, StructField, LongType
+from pyspark.sql.functions import pandas_udf, PandasUDFType, udf, expr, col
+from cleantext import sanitize, sanitize_ids, sanitize_batch, sanitize_ids_batch, shared_cache, hash_ids
+from pyspark.ml.feature import CountVectorizer, CountVectorizerModel
+from pyspark.ml.linalg import SparseVector, DenseVector, VectorUDT
+from pyspark.ml.common import _py2java
+from pyspark.ml.classification import LogisticRegression, LogisticRegressionModel
 from pyspark.ml.tuning import CrossValidator, ParamGridBuilder, CrossValidatorModel
 from pyspark.ml.evaluation import BinaryClassificationEvaluator
 
 states = ['Alabama', 'Alaska', 'Arizona', 'Arkansas', 'California', 'Colorado', 'Connecticut', 'Delaware', 'District of Columbia', 'Florida', 'Georgia', 'Hawaii', 'Idaho', 'Illinois', 'Indiana', 'Iowa', 'Kansas', 'Kentucky', 'Louisiana', 'Maine', 'Maryland', 'Massachusetts', 'Michigan', 'Minnesota', 'Mississippi', 'Missouri', 'Montana', 'Nebraska', 'Nevada', 'New Hampshire', 'New Jersey', 'New Mexico', 'New York', 'North Carolina', 'North Dakota', 'Ohio', 'Oklahoma', 'Oregon', 'Pennsylvania', 'Rhode Island', 'South Carolina', 'South Dakota', 'Tennessee', 'Texas', 'Utah', 'Vermont', 'Virginia', 'Washington', 'West Virginia', 'Wisconsin', 'Wyoming']
 
-def isStates(flair):
-	if flair in states:
-		return flair
-	else:
-		return ""
-		
-def cutId(commentId):
-	return commentId[3:]
+# The flair is kept only when it is a state name. A literal IN list of this size becomes a hash
+# set lookup in the JVM, shipped with the query plan.
+STATE_IN_LIST = ", ".join("'{}'".format(state) for state in states)
 
-def isPos(probability):
-	if probability[1] > 0.2:
-		return 1
-	else:
-		return 0
-	
-def isNeg(probability):
-	if probability[1] > 0.25:
-		return 1
-	else:
-		return 0
+# A comment is positive/negative when the classifier's probability is above these
+POS_THRESHOLD = 0.2
+NEG_THRESHOLD = 0.25
 
-def main(context):
-	"""Main function takes a Spark SQL context."""
-	# YOUR CODE HERE
-	# YOU MAY ADD OTHER FUNCTIONS AS NEEDED
-	
+def thresholdedModel(crossvalModel, threshold, predictionCol):
+	"""Copies the best model of a CrossValidatorModel so it only outputs 1/0 for probability > threshold."""
+	model = crossvalModel.bestModel.copy()
+	# PySpark 2 models have no param setters, so set them on the JVM model. With no probability
+	# and raw prediction columns the JVM computes one margin per row and compares it to threshold.
+	model._java_obj.setThreshold(threshold).setPredictionCol(predictionCol) \
+		.setProbabilityCol("").setRawPredictionCol("")
+	return model
+
+def probabilityModel(crossvalModel, prefix):
+	"""Copies the best model of a CrossValidatorModel so it outputs its probability vector as prefix_vector."""
+	model = crossvalModel.bestModel.copy()
+	model._java_obj.setPredictionCol(prefix + "_prediction").setProbabilityCol(prefix + "_vector").setRawPredictionCol("")
+	return model
+
+def positiveProbability(column):
+	"""Returns the probability of class 1 of a probability vector column."""
+	try:
+		# Spark 3, in the JVM
+		from pyspark.ml.functions import vector_to_array
+		return vector_to_array(col(column))[1]
+	except ImportError:
+		return udf(lambda vector: float(vector[1]), DoubleType())(col(column))
+
+def testProbabilities(crossvalModel, test):
+	"""Returns the probability and label of every held out comment."""
+	scored = probabilityModel(crossvalModel, "test").transform(test.select("features", "label"))
+	return scored.select(positiveProbability("test_vector").alias("probability"), "label")
+
+class HashedNgrams(object):
+	"""Hashes a column of n-gram ids (from sanitize_ids) into a sparse vector, like CountVectorizer but with no vocabulary."""
+
+	def __init__(self, inputCol, outputCol, numFeatures=1 << 18, minDF=0.0):
+		self.inputCol = inputCol
+		self.outputCol = outputCol
+		self.numFeatures = numFeatures
+		self.minDF = minDF
+
+	def fit(self, df):
+		"""Finds the hashed indices that appear in at least minDF documents."""
+		if not self.minDF:
+			return HashedNgramsModel(self.inputCol, self.outputCol, self.numFeatures)
+		numFeatures = self.numFeatures
+		documents = df.select(self.inputCol).rdd.map(lambda row: hash_ids(row[0], numFeatures))
+		documents.cache()
+		# Same meaning as CountVectorizer: a count, or a fraction of the documents when below 1
+		minCount = self.minDF if self.minDF >= 1.0 else self.minDF * documents.count()
+		kept = documents.flatMap(lambda indices: [(index, 1) for index in indices]) \
+			.reduceByKey(add) \
+			.filter(lambda pair: pair[1] >= minCount) \
+			.keys() \
+			.collect()
+		documents.unpersist()
+		return HashedNgramsModel(self.inputCol, self.outputCol, self.numFeatures, frozenset(kept))
+
+
+class HashedNgramsModel(object):
+	"""Transforms n-gram ids into binary hashed vectors, optionally only keeping the fitted indices."""
+
+	def __init__(self, inputCol, outputCol, numFeatures, kept=None):
+		self.inputCol = inputCol
+		self.outputCol = outputCol
+		self.numFeatures = numFeatures
+		self.kept = kept
+
+	def transform(self, df):
+		numFeatures = self.numFeatures
+		kept = SparkContext.getOrCreate().broadcast(self.kept) if self.kept is not None else None
+
+		def vectorize(ids):
+			indices = hash_ids(ids, numFeatures)
+			if kept is not None:
+				indices = [index for index in indices if index in kept.value]
+			return SparseVector(numFeatures, indices, [1.0] * len(indices))
+
+		return df.withColumn(self.outputCol, udf(instrumented("vectorize", vectorize), VectorUDT())(df[self.inputCol]))
+
+	def save(self, path):
+		with open(path, "w") as saved:
+			kept = sorted(self.kept) if self.kept is not None else None
+			json.dump({"inputCol": self.inputCol, "outputCol": self.outputCol, "numFeatures": self.numFeatures, "kept": kept,
+				"ngrams": "ids"}, saved)
+
+	@classmethod
+	def load(cls, path):
+		with open(path) as saved:
+			params = json.load(saved)
+		if params.get("ngrams") != "ids":
+			# Earlier models hashed the n-gram strings, their indices mean nothing now
+			raise ValueError("{} hashes n-gram strings, retrain it with --retrain".format(path))
+		kept = frozenset(params["kept"]) if params["kept"] is not None else None
+		return cls(params["inputCol"], params["outputCol"], params["numFeatures"], kept)
+
+
+def featurizer(features, numFeatures=1 << 18, minDF=10.0):
+	"""Returns the body SQL expression and the estimator for a feature mode, "vocabulary" or "hashed"."""
+	if features == "hashed":
+		# n-grams are int ids from the start, n-gram strings are never built or sent to the JVM
+		return "sanitize_ids(comments.body)", HashedNgrams(inputCol="body", outputCol="vectors", numFeatures=numFeatures, minDF=minDF)
+	return "sanitize(comments.body)", CountVectorizer(inputCol="body", outputCol="vectors", minDF=minDF, binary=True)
+
+
+COMMENTS = "comments-minimal.json.bz2"
+SUBMISSIONS = "submissions.json.bz2"
+LABELED = "labeled_data.csv"
+
+# Only the fields we use. With a schema Spark skips the inference pass over the dump and
+# does not parse the other fields.
+COMMENTS_SCHEMA = StructType([
+	StructField("id", StringType()),
+	StructField("body", StringType()),
+	StructField("link_id", StringType()),
+	StructField("author_flair_text", StringType()),
+	StructField("created_utc", LongType()),
+	StructField("score", LongType())])
+SUBMISSIONS_SCHEMA = StructType([
+	StructField("id", StringType()),
+	StructField("title", StringType()),
+	StructField("score", LongType())])
+# labeled_data.csv has no usable header, the columns are Input.id, dem, gop, djt
+LABELED_SCHEMA = StructType([StructField("_c" + str(i), StringType()) for i in range(4)])
+
+def readInput(context, path, schema):
+	"""Reads a JSON dump, or the Parquet copy of it written by ingest.py."""
+	if path.endswith(".parquet") or os.path.isdir(path):
+		return context.read.parquet(path).select([field.name for field in schema.fields])
+	return context.read.json(path, schema=schema)
+
+def registerInputs(context, comments=COMMENTS, submissions=SUBMISSIONS, labeled=LABELED):
+	"""Reads the input files into the comments, submissions and labeled views, once. A None path is skipped."""
+	views = context.tableNames()
 	# TASK 1
 	# Load files as needed, files are read and automatically converted to data frames
-	commentsDF = context.read.json("comments-minimal.json.bz2")
-	submissionsDF = context.read.json("submissions.json.bz2")
-	labeledDF = context.read.csv("labeled_data.csv")
-	
-
 	# TASKS 2, 3, 4, 5
 	# This is how you create temporary views you can execute SQL queries on.
-	commentsDF.createOrReplaceTempView("comments")
-	labeledDF.createOrReplaceTempView("labeled")
-	submissionsDF.createOrReplaceTempView("submissions")
-	
-	# Register our sanitize function as UDF, can use now after declaring as so.
-	context.udf.register("sanitize", sanitize, ArrayType(StringType()))
-	
-	# Doing a SQL query like this will create a resulting, new data frame
-	sqlDF = context.sql("""SELECT 
-		comments.id AS id, 
-		sanitize(comments.body) AS body,
-		labeled._c3 AS djt
-	FROM labeled
-	JOIN comments ON labeled._c0 = comments.id
-	""")
-	
-	
+	if comments and "comments" not in views:
+		readInput(context, comments, COMMENTS_SCHEMA).createOrReplaceTempView("comments")
+	if labeled and "labeled" not in views:
+		context.read.csv(labeled, schema=LABELED_SCHEMA).createOrReplaceTempView("labeled")
+	if submissions and "submissions" not in views:
+		readInput(context, submissions, SUBMISSIONS_SCHEMA).createOrReplaceTempView("submissions")
+
+def fileFingerprint(path):
+	"""Identifies an input by its path, size and modification time (hashing gigabytes of bz2 is too slow)."""
+	if os.path.isdir(path):
+		# A Parquet directory from ingest.py, every part file counts
+		return cacheKey(*[fileFingerprint(os.path.join(root, name))
+			for root, _, names in sorted(os.walk(path)) for name in sorted(names)])
+	stat = os.stat(path)
+	return "{}:{}:{}".format(os.path.abspath(path), stat.st_size, int(stat.st_mtime))
+
+def sourceFingerprint(module):
+	"""Hashes the source of a module, so any change to it gives a new cache key."""
+	with open(os.path.splitext(module.__file__)[0] + ".py", "rb") as source:
+		return hashlib.sha1(source.read()).hexdigest()
+
+def vectorizerFingerprint(model):
+	"""Hashes everything that decides the vectors a fitted vectorizer produces."""
+	if isinstance(model, HashedNgramsModel):
+		kept = sorted(model.kept) if model.kept is not None else []
+		return cacheKey("hashed", model.numFeatures, *kept)
+	return cacheKey("vocabulary", model.getOrDefault("binary"), *model.vocabulary)
+
+def rowsFingerprint(df):
+	"""Hashes the rows of a small DataFrame with an id column, in id order, so the same rows give the same key."""
+	return cacheKey(*[repr(tuple(row)) for row in sorted(df.collect(), key=lambda row: row.id)])
+
+def queryFingerprint(*functions):
+	"""Hashes the source of the functions building a stage's SQL, so editing a query gives a new cache key."""
+	return cacheKey(*[inspect.getsource(function) for function in functions])
+
+def cacheKey(*parts):
+	digest = hashlib.sha1()
+	for part in parts:
+		digest.update(u"{}\n".format(part).encode("utf-8"))
+	return digest.hexdigest()[:16]
+
+def cachedStage(context, cacheDir, stage, key, build, partitionBy=None):
+	"""Returns the output of a stage from the Parquet cache, running build() and saving it on a miss."""
+	if not cacheDir:
+		return build()
+	path = os.path.join(cacheDir, stage, key)
+	if not os.path.exists(os.path.join(path, "_SUCCESS")):
+		print("Cache miss for {}, building {}".format(stage, path))
+		df = build()
+		if partitionBy:
+			# One file per partition value instead of one per task and value
+			df.repartition(partitionBy).write.mode("overwrite").partitionBy(partitionBy).parquet(path)
+		else:
+			df.write.mode("overwrite").parquet(path)
+	else:
+		# The modification time is the last use, see pruneCache
+		os.utime(path, None)
+	return context.read.parquet(path)
+
+def pruneCache(cacheDir, keep=1):
+	"""Deletes all but the keep most recently used entries of every cached stage."""
+	if not os.path.isdir(cacheDir):
+		return
+	for stage in sorted(os.listdir(cacheDir)):
+		stageDir = os.path.join(cacheDir, stage)
+		entries = sorted((os.path.join(stageDir, key) for key in os.listdir(stageDir)), key=os.path.getmtime, reverse=True)
+		for entry in entries[keep:]:
+			print("Pruning {}".format(entry))
+			shutil.rmtree(entry, ignore_errors=True)
+
+def latestModelVersion(modelDir):
+	"""Returns the version of the models saved last."""
+	try:
+		with open(os.path.join(modelDir, "LATEST")) as latest:
+			return latest.read().strip()
+	except IOError:
+		raise ValueError("No saved models in {}, train them first".format(modelDir))
+
+# Probabilities and labels of the held out comments, saved with the models
+POS_TEST = "pos_test.parquet"
+NEG_TEST = "neg_test.parquet"
+
+def loadModels(modelDir, version):
+	"""Returns (features, vectorizer, positive model, negative model) saved under version, or None."""
+	path = os.path.join(modelDir, version)
+	# metadata.json is written last, a half saved version has none
+	if not os.path.exists(os.path.join(path, "metadata.json")):
+		return None
+	with open(os.path.join(path, "metadata.json")) as saved:
+		metadata = json.load(saved)
+	if metadata["features"] == "hashed":
+		cv_model = HashedNgramsModel.load(os.path.join(path, "cv.model"))
+	else:
+		cv_model = CountVectorizerModel.load(os.path.join(path, "cv.model"))
+	# The classifiers only make sense with the exact vocabulary they were trained on
+	if vectorizerFingerprint(cv_model) != metadata["vectorizer"]:
+		print("Saved models of version {} do not match their vectorizer, retraining".format(version))
+		return None
+	posModel = CrossValidatorModel.load(os.path.join(path, "pos.model"))
+	negModel = CrossValidatorModel.load(os.path.join(path, "neg.model"))
+	return metadata["features"], cv_model, posModel, negModel
+
+def saveModels(modelDir, version, features, cv_model, posModel, negModel, keep=None, tests=None):
+	"""Saves the models under version, replacing an older save of it, and marks it as the latest.
+
+	tests are the held out (posTest, negTest), their probabilities are saved for threshold_sweep.py.
+	"""
+	path = os.path.join(modelDir, version)
+	if os.path.exists(os.path.join(path, "metadata.json")):
+		os.remove(os.path.join(path, "metadata.json"))
+	if features == "hashed":
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		cv_model.save(os.path.join(path, "cv.model"))
+	else:
+		cv_model.write().overwrite().save(os.path.join(path, "cv.model"))
+	posModel.write().overwrite().save(os.path.join(path, "pos.model"))
+	negModel.write().overwrite().save(os.path.join(path, "neg.model"))
+	if tests:
+		testProbabilities(posModel, tests[0]).write.mode("overwrite").parquet(os.path.join(path, POS_TEST))
+		testProbabilities(negModel, tests[1]).write.mode("overwrite").parquet(os.path.join(path, NEG_TEST))
+	with open(os.path.join(path, "metadata.json"), "w") as saved:
+		json.dump({"features": features, "vectorizer": vectorizerFingerprint(cv_model), "saved": time.time()}, saved)
+	with open(os.path.join(modelDir, "LATEST"), "w") as latest:
+		latest.write(version)
+	if keep:
+		pruneModels(modelDir, keep)
+
+def pruneModels(modelDir, keep):
+	"""Deletes all but the keep most recently saved model versions."""
+	versions = []
+	for version in os.listdir(modelDir):
+		metadata = os.path.join(modelDir, version, "metadata.json")
+		if os.path.exists(metadata):
+			with open(metadata) as saved:
+				versions.append((json.load(saved)["saved"], version))
+	for _, version in sorted(versions, reverse=True)[keep:]:
+		print("Removing old models of version {}".format(version))
+		shutil.rmtree(os.path.join(modelDir, version))
+
+def trainModels(context, cv, sqlDF, cacheDir, labeledKey, tuning="fixed", parallelism=1, trainer="spark"):
+	"""Fits the vectorizer (unless cv is already fitted) and the positive and negative classifiers on the labeled comments."""
 	# TASK 6A
-	cv = CountVectorizer(inputCol="body", outputCol="vectors", minDF=10.0, binary=True)
-	cv_model = cv.fit(sqlDF)
-	resultDF = cv_model.transform(sqlDF)
+	cv_model = cv.fit(sqlDF) if hasattr(cv, "fit") else cv
+	resultDF = cachedStage(context, cacheDir, "labeled_vectors", cacheKey(labeledKey, vectorizerFingerprint(cv_model)),
+		lambda: cv_model.transform(sqlDF))
 	
 	# TASK 6B
 	resultDF.createOrReplaceTempView("cvtable")
@@ -109,7 +362,7 @@ def main(context):
 	negEvaluator = BinaryClassificationEvaluator()
 	# There are a few parameters associated with logistic regression. We do not know what they are a priori.
 	# We do a grid search to find the best parameters. We can replace [1.0] with a list of values to try.
-	# We will assume the parameter is 1.0. Grid search takes forever.
+	# We will assume the parameter is 1.0. Grid search takes forever (--tuning halving searches a real grid).
 	posParamGrid = ParamGridBuilder().addGrid(poslr.regParam, [1.0]).build()
 	negParamGrid = ParamGridBuilder().addGrid(neglr.regParam, [1.0]).build()
 	# We initialize a 5 fold cross-validation pipeline.
@@ -123,150 +376,789 @@ def main(context):
 		evaluator=negEvaluator,
 		estimatorParamMaps=negParamGrid,
 		numFolds=5)
+	posCrossval.setParallelism(parallelism)
+	negCrossval.setParallelism(parallelism)
 	# Although crossvalidation creates its own train/test sets for
 	# tuning, we still need a labeled test set, because it is not
 	# accessible from the crossvalidator (argh!)
 	# Split the data 50/50
 	posTrain, posTest = pos.randomSplit([0.5, 0.5])
 	negTrain, negTest = neg.randomSplit([0.5, 0.5])
-	# Train the models
-	print("Training positive classifier...")
-	posModel = posCrossval.fit(posTrain)
-	print("Training negative classifier...")
-	negModel = negCrossval.fit(negTrain)
-
-	# Once we train the models, we don't want to do it again. We can save the models and load them again later.
-	posModel.save("project2/pos.model")
-	negModel.save("project2/neg.model")
+	# Every fold reads the training sets again, keep them instead of recomputing the vectors
+	posTrain.cache()
+	negTrain.cache()
 	
+	def fit(crossval, train):
+		if trainer == "local":
+			return localCrossval(crossval, train, REG_PARAMS if tuning == "halving" else [1.0], parallelism)
+		if tuning == "halving":
+			lr = crossval.getEstimator()
+			grid = ParamGridBuilder().addGrid(lr.regParam, REG_PARAMS).addGrid(lr.elasticNetParam, ELASTIC_NET_PARAMS).build()
+			return successiveHalving(crossval.setEstimatorParamMaps(grid), train, parallelism)
+		return crossval.fit(train)
 	
-	# TASK 8
-	context.udf.register("isStates", isStates)
-	context.udf.register("cutId", cutId)
+	# Train the models, both at the same time. Spark runs jobs from different threads concurrently.
+	print("Training positive and negative classifiers...")
+	pool = ThreadPool(2)
+	posModel, negModel = pool.map(lambda args: fit(*args), [(posCrossval, posTrain), (negCrossval, negTrain)])
+	pool.close()
+	posTrain.unpersist()
+	negTrain.unpersist()
+
+	# The held out splits, for choosing the thresholds
+	return cv_model, posModel, negModel, posTest, negTest
+
+# The grid searched with --tuning halving
+REG_PARAMS = [0.001, 0.01, 0.1, 1.0]
+ELASTIC_NET_PARAMS = [0.0, 0.5, 1.0]
+
+def tuningKey(tuning):
+	"""Identifies the search of a --tuning, with its grid, for the model version."""
+	if tuning == "halving":
+		return cacheKey("halving", REG_PARAMS, ELASTIC_NET_PARAMS)
+	return "fixed"
+
+def localCrossval(crossval, train, regParams, processes=1):
+	"""Cross-validates crossval's logistic regression over regParams on this machine, as a CrossValidatorModel."""
+	# SciPy is only needed for this trainer
+	from local_trainer import to_csr, cross_validate
+	numFeatures = train.first().features.size
+	X, y = to_csr(train.select("features", "label").collect(), numFeatures)
+	coefficients, intercept, best, avgMetrics = cross_validate(X, y, regParams, crossval.getNumFolds(), processes)
+	# Scala's private[spark] constructors are public in the JVM, this is the model Spark's fit would give
+	sc = SparkContext.getOrCreate()
+	javaModel = sc._jvm.org.apache.spark.ml.classification.LogisticRegressionModel(
+		crossval.getEstimator().uid, _py2java(sc, DenseVector(coefficients)), float(intercept))
+	bestModel = LogisticRegressionModel._from_java(javaModel)
+	bestModel._java_obj.setFeaturesCol("features").setLabelCol("label")
+	lr = crossval.getEstimator()
+	print("Local training picked regParam={}".format(best))
+	# Same result type as CrossValidator.fit, so the model saves, loads and scores the same way
+	crossval = crossval.copy().setEstimatorParamMaps(ParamGridBuilder().addGrid(lr.regParam, regParams).build())
+	return crossval._copyValues(CrossValidatorModel(bestModel, avgMetrics))
+
+def cachedFolds(df, numFolds, seed=None):
+	"""Splits df into numFolds cached (train, validation) pairs, shared by every grid point."""
+	splits = df.randomSplit([1.0] * numFolds, seed)
+	folds = []
+	for i, validation in enumerate(splits):
+		train = None
+		for j, split in enumerate(splits):
+			if j != i:
+				train = split if train is None else train.union(split)
+		folds.append((train.cache(), validation.cache()))
+	return folds
+
+def successiveHalving(crossval, df, parallelism=1, eta=3):
+	"""Cross validates the grid of crossval by successive halving, returns a CrossValidatorModel of the best point."""
+	# Every round fits the remaining points on the cached folds and keeps the best 1/eta of them.
+	# Round i of s gets maxIter * eta^(i - (s - 1)) iterations, so the last round, which picks
+	# the winner, fits at the full maxIter and its metric is the one recorded.
+	lr = crossval.getEstimator()
+	evaluator = crossval.getEvaluator()
+	candidates = crossval.getEstimatorParamMaps()
+	maxIter = lr.getMaxIter()
+	folds = cachedFolds(df, crossval.getNumFolds(), crossval.getSeed())
+	pool = ThreadPool(parallelism)
+
+	def evaluate(task):
+		params, (train, validation) = task
+		return evaluator.evaluate(lr.fit(train, params).transform(validation))
+
+	# Enough rounds to get down to one point, at least one so the winner's metric is measured
+	rounds = 0
+	remaining = len(candidates)
+	while remaining > 1:
+		remaining = max(1, remaining // eta)
+		rounds += 1
+	rounds = max(1, rounds)
+	metric = None
+	for i in range(rounds):
+		iterations = max(1, int(round(maxIter * float(eta) ** (i - (rounds - 1)))))
+		budgeted = []
+		for params in candidates:
+			params = params.copy()
+			params[lr.maxIter] = iterations
+			budgeted.append(params)
+		scores = pool.map(evaluate, [(params, fold) for params in budgeted for fold in folds])
+		metrics = [sum(scores[j * len(folds):(j + 1) * len(folds)]) / len(folds) for j in range(len(budgeted))]
+		print("Evaluated {} grid points with maxIter={}".format(len(budgeted), iterations))
+		ranked = sorted(range(len(budgeted)), key=lambda j: metrics[j], reverse=evaluator.isLargerBetter())
+		candidates = [budgeted[j] for j in ranked[:max(1, len(budgeted) // eta)]]
+		metric = metrics[ranked[0]]
+	pool.close()
+	for train, validation in folds:
+		train.unpersist()
+		validation.unpersist()
+
+	bestParams = candidates[0].copy()
+	bestParams[lr.maxIter] = maxIter
+	# Same result type as CrossValidator.fit, so the model saves, loads and scores the same way
+	crossval = crossval.copy().setEstimatorParamMaps([bestParams])
+	return crossval._copyValues(CrossValidatorModel(lr.fit(df, bestParams), [metric]))
+
+def loadAggregateState(stateDir):
+	"""Returns the saved watermark and partial aggregates of incremental runs, or None before the first."""
+	try:
+		with open(os.path.join(stateDir, "CURRENT")) as current:
+			return json.load(current)
+	except IOError:
+		return None
+
+def saveAggregateState(context, stateDir, partials, state, scored):
+	"""Saves the merged partial aggregates and moves the watermark past the comments just scored.
+
+	Returns the saved partials read back, since the given ones may still read the old state.
+	"""
+	path = os.path.join(stateDir, "partials-{}".format(int(time.time() * 1000)))
+	partials.write.parquet(path)
+	latest = scored.agg({"timestamp": "max"}).collect()[0][0]
+	if latest is None:
+		# Nothing new this run, keep the old watermark
+		latest, ids = (state["created_utc"], state["ids"]) if state else (None, [])
+	else:
+		# Comments from the watermark's own second may still arrive in the next dump
+		ids = [row.id for row in scored.where(scored.timestamp == latest).select("id").collect()]
+		if state and state["created_utc"] == latest:
+			ids = sorted(set(ids) | set(state["ids"]))
+	with open(os.path.join(stateDir, "CURRENT.tmp"), "w") as current:
+		json.dump({"partials": path, "created_utc": latest, "ids": ids}, current)
+	os.rename(os.path.join(stateDir, "CURRENT.tmp"), os.path.join(stateDir, "CURRENT"))
+	saved = context.read.parquet(path)
+	if state:
+		shutil.rmtree(state["partials"], ignore_errors=True)
+	return saved
+
+def watermarkFilter(state, column="created_utc"):
+	"""SQL condition on comments that keeps only the ones after the saved watermark, column is their created time."""
+	if not state or state["created_utc"] is None:
+		return "TRUE"
+	condition = "{} > {}".format(column, state["created_utc"])
+	if state["ids"]:
+		seen = ", ".join("'{}'".format(commentId) for commentId in state["ids"])
+		condition = "({} OR ({} = {} AND id NOT IN ({})))".format(condition, column, state["created_utc"], seen)
+	return condition
+
+# Metrics summed over the Spark stages of a report stage, with their names in the REST API
+STAGE_METRICS = ["inputBytes", "inputRecords", "outputBytes", "outputRecords",
+	"shuffleReadBytes", "shuffleReadRecords", "shuffleWriteBytes", "shuffleWriteRecords", "executorRunTime"]
+
+class RunReport(object):
+	"""Opt-in report of a run: wall time, Spark job metrics, rows and Python UDF counters of each stage, saved as JSON."""
+
+	# The enabled report of this run, looked up by instrumented() when a UDF is created
+	active = None
+
+	def __init__(self, context, path=None, profileDir=None):
+		self.path = path
+		self.profileDir = profileDir
+		self.stages = []
+		self.counters = {}
+		# (stage index, DataFrame) cached by rows() and not by the run itself
+		self.cached = []
+		if path:
+			self.sc = context._sc
+			self.started = time.time()
+			RunReport.active = self
+
+	def stage(self, name):
+		"""Ends the current stage and starts the next one."""
+		if not self.path:
+			return
+		now = time.time()
+		self._end(now)
+		self.stages.append({"name": name, "start": now, "rows": {}, "udfs": self._udfTotals()})
+		# The stage that just ended may still read what the one before it cached, not the older ones
+		self._unpersist(len(self.stages) - 3)
+
+	def rows(self, label, df):
+		"""Caches and counts df when reporting, so its cost is in this stage and not the ones reading it.
+
+		What only the report cached is unpersisted once the next stage is over, so the run keeps
+		the memory it would have without a report.
+		"""
+		if not self.path:
+			return df
+		owned = not df.is_cached
+		df = df.cache()
+		self.stages[-1]["rows"][label] = df.count()
+		if owned:
+			self.cached.append((len(self.stages) - 1, df))
+		return df
+
+	def _unpersist(self, last):
+		for index, df in [entry for entry in self.cached if entry[0] <= last]:
+			df.unpersist()
+		self.cached = [entry for entry in self.cached if entry[0] > last]
+
+	def udfCounters(self, name):
+		"""Returns the calls, rows and seconds accumulators of a UDF."""
+		counters = self.counters.setdefault(name, {})
+		for key, zero in [("calls", 0), ("rows", 0), ("seconds", 0.0)]:
+			if key not in counters:
+				counters[key] = self.sc.accumulator(zero)
+		return counters["calls"], counters["rows"], counters["seconds"]
+
+	def cacheCounters(self, name):
+		"""Returns the cache hits and misses accumulators of a UDF."""
+		counters = self.counters.setdefault(name, {})
+		for key in ["cache_hits", "cache_misses"]:
+			if key not in counters:
+				counters[key] = self.sc.accumulator(0)
+		return counters["cache_hits"], counters["cache_misses"]
+
+	def _udfTotals(self):
+		return dict((name, dict((key, accumulator.value) for key, accumulator in counters.items()))
+			for name, counters in self.counters.items())
+
+	def _end(self, now):
+		if not self.stages or "end" in self.stages[-1]:
+			return
+		stage = self.stages[-1]
+		stage["end"] = now
+		stage["seconds"] = now - stage["start"]
+		# The counters are totals over the run, keep what changed during the stage
+		before = stage["udfs"]
+		stage["udfs"] = dict((name, dict((key, value - before.get(name, {}).get(key, 0)) for key, value in totals.items()))
+			for name, totals in self._udfTotals().items())
+
+	def write(self):
+		"""Ends the last stage, adds the Spark metrics of the jobs started during each stage and saves the report."""
+		if not self.path:
+			return
+		self._end(time.time())
+		self._unpersist(len(self.stages))
+		jobs, sparkStages = sparkMetrics(self.sc)
+		for stage in self.stages:
+			if jobs is None:
+				continue
+			# Spark runs the jobs of a lazy stage wherever its output is first needed, which is
+			# the stage they are reported in
+			stageIds = set(stageId for job in jobs if stage["start"] <= uiTime(job["submissionTime"]) < stage["end"]
+				for stageId in job["stageIds"])
+			stage["jobs"] = sum(1 for job in jobs if stage["start"] <= uiTime(job["submissionTime"]) < stage["end"])
+			for metric in STAGE_METRICS:
+				stage[metric] = sum(sparkStage.get(metric, 0) for sparkStage in sparkStages if sparkStage["stageId"] in stageIds)
+		if self.profileDir:
+			# cProfile stats of the Python workers, one file per RDD/UDF, when spark.python.profile is set
+			self.sc.dump_profiles(self.profileDir)
+		report = {
+			"application": self.sc.applicationId,
+			"spark": self.sc.version,
+			"started": self.started,
+			"seconds": time.time() - self.started,
+			"stages": self.stages,
+			"profiles": self.profileDir,
+		}
+		with open(self.path, "w") as saved:
+			json.dump(report, saved, indent=2, sort_keys=True)
+		print("Wrote the run report to {}".format(self.path))
+		RunReport.active = None
+
+def sparkMetrics(sc):
+	"""Returns the jobs and stages of this application from the Spark UI's REST API, None when there is no UI."""
+	if not sc.uiWebUrl:
+		return None, None
+	base = "{}/api/v1/applications/{}".format(sc.uiWebUrl, sc.applicationId)
+	try:
+		jobs = json.loads(urlopen(base + "/jobs").read().decode("utf-8"))
+		stages = json.loads(urlopen(base + "/stages").read().decode("utf-8"))
+	except (IOError, ValueError):
+		return None, None
+	return jobs, stages
+
+def uiTime(text):
+	"""Parses a time of the Spark REST API, like 2018-03-01T12:00:00.123GMT, into a Unix time."""
+	parsed = datetime.datetime.strptime(text[:23], "%Y-%m-%dT%H:%M:%S.%f")
+	return calendar.timegm(parsed.timetuple()) + parsed.microsecond / 1e6
+
+def instrumented(name, function, vectorized=False):
+	"""Wraps the function of a Python UDF to count its calls, rows and time when a run report is enabled."""
+	report = RunReport.active
+	if report is None:
+		return function
+	calls, rows, seconds = report.udfCounters(name)
 	
-	# removing the sarcasm and quotes
-	noSarcasmDF = context.sql("""SELECT 
+	def counted(*columns):
+		start = time.time()
+		result = function(*columns)
+		seconds.add(time.time() - start)
+		calls.add(1)
+		rows.add(len(columns[0]) if vectorized else 1)
+		return result
+	
+	return counted
+
+def cachedBatch(name, batch, function, cacheEntries, cacheBytes):
+	"""Runs batch with the worker's LRU cache of function, counting its hits and misses when a run report is enabled."""
+	report = RunReport.active
+	counters = report.cacheCounters(name) if report is not None else None
+	
+	def cached(texts):
+		# Every Python worker keeps one cache across all the batches it sanitizes
+		cache = shared_cache(cacheEntries, cacheBytes, function)
+		hits, misses = cache.hits, cache.misses
+		result = batch(texts, cache)
+		if counters is not None:
+			counters[0].add(cache.hits - hits)
+			counters[1].add(cache.misses - misses)
+		return result
+	
+	return cached
+
+def registerSanitize(context, cacheEntries=0, cacheBytes=64 << 20):
+	"""Registers sanitize for SQL as a vectorized (Arrow) UDF, bodies go to Python a column batch at a time."""
+	function = sanitize_batch
+	idsFunction = sanitize_ids_batch
+	if cacheEntries:
+		function = cachedBatch("sanitize", sanitize_batch, sanitize, cacheEntries, cacheBytes)
+		idsFunction = cachedBatch("sanitize_ids", sanitize_ids_batch, sanitize_ids, cacheEntries, cacheBytes)
+	context.udf.register("sanitize", pandas_udf(instrumented("sanitize", function, True), ArrayType(StringType()), PandasUDFType.SCALAR))
+	# The compact form for hashed features, 4 bytes per n-gram instead of a string
+	context.udf.register("sanitize_ids", pandas_udf(instrumented("sanitize_ids", idsFunction, True),
+		ArrayType(IntegerType()), PandasUDFType.SCALAR))
+
+def labeledComments(context, bodyExpr):
+	"""Joins the labeled and comments views into the training comments, with body as bodyExpr."""
+	# Doing a SQL query like this will create a resulting, new data frame
+	# labeled is a few thousand rows, broadcast it rather than shuffle the comments
+	return context.sql("""SELECT /*+ BROADCAST(labeled) */
+		comments.id AS id, 
+		{} AS body,
+		labeled._c3 AS djt
+	FROM labeled
+	JOIN comments ON labeled._c0 = comments.id
+	""".format(bodyExpr))
+
+def scoringComments(context, bodyExpr, newComments="TRUE", dedup=False):
+	"""Joins the comments and submissions views into the comments to score, with body as bodyExpr."""
+	if dedup:
+		return dedupedBodies(context, scoringComments(context, "comments.body", newComments), bodyExpr)
+	# removing the sarcasm and quotes before the join, so sanitize only sees comments we keep.
+	# The join key is a native substring (link_id is "t3_" + submission id) and the small,
+	# projected submissions table is broadcast instead of shuffling the comments.
+	# 'y' is the calendar year, 'Y' would be the week year and date 2017-12-31 as 2018-12-31.
+	return context.sql("""SELECT /*+ BROADCAST(submissions) */
 		comments.created_utc AS timestamp, 
+		FROM_UNIXTIME(comments.created_utc, 'y-M-d') AS date,
 		submissions.title AS title,
-		isStates(comments.author_flair_text) AS state,
+		CASE WHEN comments.author_flair_text IN ({}) THEN comments.author_flair_text ELSE '' END AS state,
 		comments.id AS id,
-		sanitize(comments.body) AS body,
+		{} AS body,
 		comments.score AS comment_score,
 		submissions.score AS story_score
-	FROM comments
-	JOIN submissions ON cutId(comments.link_id) = submissions.id
-	WHERE comments.body NOT LIKE '&gt%' AND comments.body NOT LIKE '%/s%'
-	""")
-  
-	# TASK 9
-	#repeated names hopefully won't matter here
-	resultDF = cv_model.transform(noSarcasmDF)
+	FROM (
+		SELECT id, body, link_id, author_flair_text, created_utc, score
+		FROM comments
+		WHERE body NOT LIKE '&gt%' AND body NOT LIKE '%/s%' AND {}
+	) comments
+	JOIN (SELECT id, title, score FROM submissions) submissions ON SUBSTR(comments.link_id, 4) = submissions.id
+	""".format(STATE_IN_LIST, bodyExpr, newComments))
+
+def dedupedBodies(context, df, bodyExpr):
+	"""Evaluates bodyExpr once per distinct body of df and joins it back, as body."""
+	# Costs a shuffle of the bodies, which pays off when many are the same ("[deleted]",
+	# "[removed]", bot replies, copypasta) and sanitize is the expensive part
+	df.createOrReplaceTempView("rawBodies")
+	return context.sql("""SELECT
+		rawBodies.timestamp,
+		rawBodies.date,
+		rawBodies.title,
+		rawBodies.state,
+		rawBodies.id,
+		bodies.body,
+		rawBodies.comment_score,
+		rawBodies.story_score
+	FROM rawBodies
+	JOIN (
+		SELECT comments.body AS raw_body, {} AS body
+		FROM (SELECT DISTINCT body FROM rawBodies) comments
+	) bodies ON rawBodies.body = bodies.raw_body
+	""".format(bodyExpr))
+
+# The table classify gives with keepProbabilities. Read back with it, Spark would otherwise
+# infer the 'y-M-d' date partition values as dates, and they would no longer match the string
+# dates of other runs.
+SCORED_SCHEMA = StructType([
+	StructField("timestamp", LongType()),
+	StructField("date", StringType()),
+	StructField("title", StringType()),
+	StructField("state", StringType()),
+	StructField("id", StringType()),
+	StructField("comment_score", LongType()),
+	StructField("story_score", LongType()),
+	StructField("pos", IntegerType()),
+	StructField("neg", IntegerType()),
+	StructField("pos_probability", DoubleType()),
+	StructField("neg_probability", DoubleType())])
+
+def classify(context, resultDF, posModel, negModel, keepProbabilities=False):
+	"""Applies both classifiers to the vectorized comments, giving pos and neg as 1/0 columns.
+
+	With keepProbabilities the pos_probability and neg_probability columns are kept too.
+	"""
+	features = resultDF.withColumnRenamed("vectors", "features")
+	if keepProbabilities:
+		posResult = probabilityModel(posModel, "pos").transform(features)
+		posResult = posResult.withColumn("pos_probability", positiveProbability("pos_vector"))
+		posNegResult = probabilityModel(negModel, "neg").transform(posResult)
+		posNegResult = posNegResult.withColumn("neg_probability", positiveProbability("neg_vector"))
+		posNegResult.createOrReplaceTempView("posNegTable")
+		return context.sql("""SELECT
+			timestamp,
+			FROM_UNIXTIME(timestamp, 'y-M-d') AS date,
+			title,
+			state,
+			id,
+			comment_score,
+			story_score,
+			CAST(pos_probability > {} AS INT) AS pos,
+			CAST(neg_probability > {} AS INT) AS neg,
+			pos_probability,
+			neg_probability
+		FROM posNegTable
+		""".format(POS_THRESHOLD, NEG_THRESHOLD))
+	# Both classifiers and their thresholds run in the JVM, pipelined in one pass over the rows,
+	# with no Python UDF and no probability vectors. body and features are dropped before the
+	# aggregations so they never reach a shuffle.
+	posResult = thresholdedModel(posModel, POS_THRESHOLD, "pos").transform(features)
+	posNegResult = thresholdedModel(negModel, NEG_THRESHOLD, "neg").transform(posResult)
 	
-	resultDF.createOrReplaceTempView("cvtable")
+	posNegResult.createOrReplaceTempView("posNegTable")
 	
-	#new positive results
-	positives = context.sql("""SELECT 
+	return context.sql("""SELECT
 		timestamp,
+		FROM_UNIXTIME(timestamp, 'y-M-d') AS date,
 		title,
 		state,
 		id,
-		body,
 		comment_score,
 		story_score,
-		vectors AS features
-	FROM cvtable
+		CAST(pos AS INT) AS pos,
+		CAST(neg AS INT) AS neg
+	FROM posNegTable
 	""")
-	
-	posResult = posModel.transform(positives).selectExpr("timestamp", "title", 
-	"state", "id", "body", "comment_score", "story_score", "features", "probability AS pos", 
-	"prediction as pos_prediction", "rawPrediction as pos_rawPred")
-	posNegResult = negModel.transform(posResult)
-	
-	posNegResult.createOrReplaceTempView("posNegTable")
-	
-	context.udf.register("isPos", isPos)
-	context.udf.register("isNeg", isNeg)
-	
-	#I didn't bother aliasing the "probability" column for the negative
-	probTable = context.sql("""SELECT
-		timestamp,
+
+def aggregatePartials(context, probTable, state=None):
+	"""Returns sum(pos), sum(neg) and count per title, date, state, comment and story score, merged with state."""
+	probTable.createOrReplaceTempView("finalProbs")
+	# All five groupings in one pass over the scored comments and one shuffle. The result is
+	# small and cached, so every output (and the top 10s) is read from it instead of
+	# re-running the whole pipeline once per query. Sums and counts rather than averages, so
+	# the partial aggregates of incremental runs can be merged.
+	partials = context.sql("""SELECT
+		CASE
+			WHEN GROUPING(title) = 0 THEN 'title'
+			WHEN GROUPING(date) = 0 THEN 'date'
+			WHEN GROUPING(state) = 0 THEN 'state'
+			WHEN GROUPING(comment_score) = 0 THEN 'comment_score'
+			ELSE 'story_score'
+		END AS dimension,
 		title,
+		date,
 		state,
-		id,
-		body,
 		comment_score,
 		story_score,
-		features,
-		isPos(pos) AS pos,
-		isNeg(probability) AS neg
-	FROM posNegTable
+		SUM(pos) AS sum_pos,
+		SUM(neg) AS sum_neg,
+		COUNT(*) AS count
+	FROM finalProbs
+	GROUP BY title, date, state, comment_score, story_score
+	GROUPING SETS ((title), (date), (state), (comment_score), (story_score))
 	""")
+	if state:
+		partials.union(context.read.parquet(state["partials"])).createOrReplaceTempView("partials")
+		partials = context.sql("""SELECT
+			dimension, title, date, state, comment_score, story_score,
+			SUM(sum_pos) AS sum_pos,
+			SUM(sum_neg) AS sum_neg,
+			SUM(count) AS count
+		FROM partials
+		GROUP BY dimension, title, date, state, comment_score, story_score
+		""")
+	return partials
+
+# Score bins per power of ten, see scoreBins
+BINS_PER_DECADE = 10
+
+def scoreBins(partials, dimension, column, binsPerDecade=BINS_PER_DECADE):
+	"""Returns the sentiment of log spaced score bins, weighted by the comments in each score."""
+	# Bin 0 is score 0, bin n > 0 covers scores from 10^((n - 1) / binsPerDecade) and
+	# negative scores mirror that, so the rows stay a few hundred however many scores there are
+	return partials.where("dimension = '{}'".format(dimension)) \
+		.selectExpr("{0} AS score".format(column),
+			"CASE WHEN {0} = 0 THEN 0 ELSE CAST(SIGNUM({0}) * (FLOOR(LOG10(ABS({0})) * {1}) + 1) AS BIGINT) END AS bin"
+				.format(column, binsPerDecade),
+			"sum_pos", "sum_neg", "count") \
+		.groupBy("bin") \
+		.agg(expr("MIN(score) AS score_low"), expr("MAX(score) AS score_high"),
+			expr("SUM(sum_pos) / SUM(count) AS Positive"), expr("SUM(sum_neg) / SUM(count) AS Negative"),
+			expr("SUM(sum_pos) AS sum_pos"), expr("SUM(sum_neg) AS sum_neg"), expr("SUM(count) AS count"))
+
+def sentimentOutputs(partials):
+	"""Returns the Task 10 output tables, as (name, DataFrame) pairs, from the partial aggregates."""
+	aggregates = partials.selectExpr("dimension", "title", "date", "state", "comment_score", "story_score",
+		"sum_pos / count AS Positive", "sum_neg / count AS Negative", "sum_pos", "sum_neg", "count")
+	# The sums and counts let coarser groupings be rolled up from the outputs, see rollup.py
+	totals = ["Positive", "Negative", "sum_pos", "sum_neg", "count"]
 	
-	probTable.createOrReplaceTempView("finalProbs")
+	totalPercent = aggregates.where("dimension = 'title'").select("title", *totals)
+	datePercent = aggregates.where("dimension = 'date'").select("date", *totals)
+	statePercent = aggregates.where("dimension = 'state' AND state <> ''").select("state", *totals)
+	commentPercent = aggregates.where("dimension = 'comment_score'").select("comment_score", *totals)
+	storyPercent = aggregates.where("dimension = 'story_score'") \
+		.selectExpr("story_score AS submission_score", *totals)
 	
-	# TASK 10
-	totalPercent = context.sql("""SELECT
-		title,
-		AVG(pos) AS Positive,
-		AVG(neg) AS Negative
-	FROM finalProbs
-	GROUP BY title
-	""")
+	return [
+		#the original table
+		#Task 10 Part 1
+		("totalPercent", totalPercent),
+		#Task 10 Part 2
+		("time_data", datePercent),
+		#Task 10 Part 3
+		("state_data", statePercent),
+		#Task 10 Part 4
+		("comment_score", commentPercent),
+		("submission_score", storyPercent),
+		# For the score plots, the same however many distinct scores there are
+		("comment_score_bins", scoreBins(partials, "comment_score", "comment_score")),
+		("submission_score_bins", scoreBins(partials, "story_score", "story_score")),
+		#this is for report part 4 that is done in Spark
+		("positiveTop", totalPercent.orderBy("Positive", ascending=False).limit(10)),
+		("negativeTop", totalPercent.orderBy("Negative", ascending=False).limit(10)),
+	]
+
+def writeOutputs(outputs, outputDir=".", outputFormat="csv", partitions=1):
+	"""Saves each output as a name.csv (with a header) or name.parquet directory of partitions part files.
+
+	partitions=0 keeps Spark's partitioning, every task then writes its own part file.
+	"""
+	for name, df in outputs:
+		if partitions:
+			df = df.repartition(partitions)
+		path = os.path.join(outputDir, name + "." + outputFormat)
+		if outputFormat == "parquet":
+			df.write.mode("overwrite").parquet(path)
+		else:
+			#saving into csvs
+			df.write.mode("overwrite").format("com.databricks.spark.csv").option("header", "true").save(path)
+
+# Stages main can run, in order
+STAGES = ["train", "score", "aggregate"]
+
+def inputBytes(path):
+	"""Estimates the uncompressed bytes of an input file or directory."""
+	if not path or not os.path.exists(path):
+		return 0
+	if os.path.isdir(path):
+		return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+	# Reddit's JSON compresses about 8 to 1 with bz2
+	return os.path.getsize(path) * (8 if path.endswith(".bz2") else 1)
+
+def shufflePartitions(context, *paths):
+	"""Returns a shuffle partition count giving about 128 MB of input per partition, at least one per core."""
+	return max(context._sc.defaultParallelism, sum(inputBytes(path) for path in paths) // (128 << 20))
+
+def main(context, features="vocabulary", numFeatures=1 << 18, minDF=10.0, cacheDir="feature_cache",
+		comments=COMMENTS, submissions=SUBMISSIONS, labeled=LABELED,
+		modelDir="project2", retrain=False, scoreOnly=False, modelVersion=None, keepModels=None,
+		incremental=False, stateDir="aggregate_state", tuning="fixed", parallelism=1, reportPath=None, profileDir=None,
+		dedup=False, sanitizeCache=0, trainer="spark", scoredTable=None,
+		stages=STAGES, outputDir=".", outputFormat="csv", outputPartitions=1, shuffle=None):
+	"""Main function takes a Spark SQL context."""
+	# YOUR CODE HERE
+	# YOU MAY ADD OTHER FUNCTIONS AS NEEDED
 	
-	datePercent = context.sql("""SELECT 
-		FROM_UNIXTIME(timestamp, 'Y-M-d') AS date,
-		AVG(pos) AS Positive,
-		AVG(neg) AS Negative
-	FROM finalProbs
-	GROUP BY date
-	""")
+	if shuffle == "auto":
+		shuffle = shufflePartitions(context, comments, submissions)
+	if shuffle:
+		context.setConf("spark.sql.shuffle.partitions", str(shuffle))
+	# Without the train stage the saved models are used. So do incremental runs: a dump of only
+	# new comments has none of the labeled ones, there is nothing to train on.
+	scoreOnly = scoreOnly or "train" not in stages or incremental
 	
-	statePercent = context.sql("""SELECT 
-		state,
-		AVG(pos) AS Positive,
-		AVG(neg) AS Negative
-	FROM finalProbs
-	WHERE state <> ""
-	GROUP BY state
-	""")	
+	# Does nothing unless a report path is given
+	report = RunReport(context, reportPath, profileDir)
+	report.stage("setup")
+	# Register our sanitize function as UDF, can use now after declaring as so.
+	registerSanitize(context, sanitizeCache)
 	
-	commentPercent = context.sql("""SELECT
-		comment_score,
-		AVG(pos) AS Positive,
-		AVG(neg) AS Negative
-	FROM finalProbs
-	GROUP BY comment_score
-	""")
+	state = loadAggregateState(stateDir) if incremental else None
+	if "train" in stages or "score" in stages:
+		# The saved models and cached stages are only valid for the same inputs and the same sanitize
+		cleantextKey = sourceFingerprint(cleantext)
+		if scoreOnly:
+			version = modelVersion or latestModelVersion(modelDir)
+			models = loadModels(modelDir, version)
+			if models is None:
+				option = "--incremental" if incremental else "--score-only"
+				raise ValueError("{} needs a trained model, none found for version {} in {}, run without it first".format(
+					option, version, modelDir))
+		else:
+			# In hashed mode body is an array of n-gram ids, only turned into a vector when vectorized
+			bodyExpr, cv = featurizer(features, numFeatures, minDF)
+			labeledKey = cacheKey(fileFingerprint(labeled), fileFingerprint(comments), cleantextKey, bodyExpr,
+				queryFingerprint(labeledComments))
+			report.stage("labeled")
+			def labeledBody():
+				registerInputs(context, comments, None, labeled)
+				return labeledComments(context, bodyExpr)
+		
+			sqlDF = report.rows("labeled", cachedStage(context, cacheDir, "labeled", labeledKey, labeledBody))
+			# The models only depend on the labeled comments and their bodies, a new comments dump
+			# with the same labeled bodies keeps the same version, and on how they are trained and tuned
+			version = cacheKey(rowsFingerprint(sqlDF), features, numFeatures, minDF, tuningKey(tuning), trainer)
+			models = None if retrain else loadModels(modelDir, version)
 	
-	storyPercent = context.sql("""SELECT
-		story_score AS submission_score,
-		AVG(pos) AS Positive,
-		AVG(neg) AS Negative
-	FROM finalProbs
-	GROUP BY story_score
-	""")
+		if models is None:
+			report.stage("train")
+			cv_model, posModel, negModel, posTest, negTest = trainModels(context, cv, sqlDF, cacheDir, labeledKey,
+				tuning, parallelism, trainer)
+			report.stage("save models")
+			# Once we train the models, we don't want to do it again. We save the models and load them again later.
+			saveModels(modelDir, version, features, cv_model, posModel, negModel, keepModels, (posTest, negTest))
+		else:
+			print("Using the saved models of version {}".format(version))
+			features, cv_model, posModel, negModel = models
+	if "score" not in stages and "aggregate" not in stages:
+		report.write()
+		return
+	if "score" in stages:
+		bodyExpr = featurizer(features)[0]
+		cvKey = vectorizerFingerprint(cv_model)
+		# In incremental mode only comments after the last run's watermark are scored
+		newComments = watermarkFilter(state)
+		scoringKey = cacheKey(fileFingerprint(comments), fileFingerprint(submissions), cleantextKey, bodyExpr, newComments,
+			queryFingerprint(scoringComments, dedupedBodies), STATE_IN_LIST)
 	
-	#saving into csvs
-	#the original table
-	#Task 10 Part 1
-	totalPercent.repartition(1).write.format("com.databricks.spark.csv").option("header", "true").save("totalPercent.csv")
-	#Task 10 Part 2
-	datePercent.repartition(1).write.format("com.databricks.spark.csv").option("header", "true").save("time_data.csv")
-	#Task 10 Part 3
-	statePercent.repartition(1).write.format("com.databricks.spark.csv").option("header", "true").save("state_data.csv")
-	#Task 10 Part 4
-	commentPercent.repartition(1).write.format("com.databricks.spark.csv").option("header", "true").save("comment_score.csv")
-	storyPercent.repartition(1).write.format("com.databricks.spark.csv").option("header", "true").save("submission_score.csv")
 	
-	#this is for report part 4 that is done in Spark
-	totalPercent.orderBy("Positive", ascending=False).limit(10).repartition(1).write.format("com.databricks.spark.csv").option("header","true").save("positiveTop.csv")
-	totalPercent.orderBy("Negative", ascending=False).limit(10).repartition(1).write.format("com.databricks.spark.csv").option("header","true").save("negativeTop.csv")
+		# TASK 8
+		report.stage("scoring")
+		def scoringBody():
+			registerInputs(context, comments, submissions, None)
+			return scoringComments(context, bodyExpr, newComments, dedup)
   
+		# TASK 9
+		#repeated names hopefully won't matter here
+		# A cache hit here skips reading, joining and sanitizing the comments entirely
+		resultDF = cachedStage(context, cacheDir, "scoring_vectors", cacheKey(scoringKey, cvKey),
+			lambda: cv_model.transform(cachedStage(context, cacheDir, "scoring", scoringKey, scoringBody, "date")), "date")
+		resultDF = report.rows("scoring", resultDF)
+	
+		report.stage("classify")
+		if scoredTable:
+			# The probabilities are kept, so threshold_sweep.py can try other thresholds on this table
+			classify(context, resultDF, posModel, negModel, True) \
+				.write.mode("overwrite").partitionBy("date").parquet(scoredTable)
+			probTable = context.read.schema(SCORED_SCHEMA).parquet(scoredTable)
+		else:
+			probTable = classify(context, resultDF, posModel, negModel)
+	else:
+		# Aggregate only, from the comments a previous run scored and kept
+		report.stage("read scored")
+		probTable = context.read.schema(SCORED_SCHEMA).parquet(scoredTable).where(watermarkFilter(state, "timestamp"))
+	if incremental and "aggregate" in stages:
+		# Read again for the new watermark
+		probTable.cache()
+	probTable = report.rows("classified", probTable)
+	if "aggregate" not in stages:
+		report.write()
+		return
+	
+	# TASK 10
+	report.stage("aggregate")
+	partials = aggregatePartials(context, probTable, state)
+	partials.cache()
+	partials = report.rows("partials", partials)
+	if incremental:
+		report.stage("save state")
+		partials = saveAggregateState(context, stateDir, partials, state, probTable)
+	report.stage("write")
+	writeOutputs(sentimentOutputs(partials), outputDir, outputFormat, outputPartitions)
+	report.write()
+
 
 if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Score /r/politics comments for sentiment towards President Trump.")
+	parser.add_argument("--comments", default=COMMENTS, help="comments dump, .json.bz2 or a .parquet directory from ingest.py")
+	parser.add_argument("--submissions", default=SUBMISSIONS, help="submissions dump, .json.bz2 or a .parquet directory from ingest.py")
+	parser.add_argument("--labeled", default=LABELED)
+	parser.add_argument("--features", choices=["vocabulary", "hashed"], default="vocabulary",
+		help="CountVectorizer vocabulary, or hashed n-grams with no fit pass over the strings")
+	parser.add_argument("--num-features", type=int, default=1 << 18, help="vector size in hashed mode")
+	parser.add_argument("--min-df", type=float, default=10.0, help="minimum document frequency of a feature, 0 keeps all in hashed mode")
+	parser.add_argument("--cache-dir", default="feature_cache", help="Parquet cache of the sanitized and vectorized comments")
+	parser.add_argument("--no-cache", dest="cache_dir", action="store_const", const=None, help="always recompute every stage")
+	parser.add_argument("--prune-cache", type=int, metavar="KEEP",
+		help="after the run, delete all but the KEEP most recently used entries of every cached stage")
+	parser.add_argument("--model-dir", default="project2", help="saved models, one directory per labeled data and vectorizer version")
+	parser.add_argument("--retrain", action="store_true", help="train even if compatible models are saved, replacing them")
+	parser.add_argument("--keep-models", type=int, help="after saving, delete all but this many model versions")
+	parser.add_argument("--score-only", action="store_true", help="skip training and score with the latest saved models")
+	parser.add_argument("--model-version", help="with --score-only, the saved version to use instead of the latest")
+	parser.add_argument("--tuning", choices=["fixed", "halving"], default="fixed",
+		help="regParam=1.0 only, or successive halving over a regParam x elasticNetParam grid")
+	parser.add_argument("--parallelism", type=int, default=1, help="grid points and folds fitted at the same time")
+	parser.add_argument("--incremental", action="store_true",
+		help="only score comments newer than the last incremental run, with the saved models, and merge them into its aggregates")
+	parser.add_argument("--state-dir", default="aggregate_state", help="watermark and partial aggregates of incremental runs")
+	parser.add_argument("--report", help="write a JSON report of time, rows, Spark metrics and UDF calls per stage here")
+	parser.add_argument("--profile-dir", help="with --report, also dump cProfile stats of the Python workers here")
+	parser.add_argument("--dedup", action="store_true", help="sanitize each distinct comment body once and join it back")
+	parser.add_argument("--sanitize-cache", type=int, default=0, metavar="ENTRIES",
+		help="keep an LRU cache of this many sanitized bodies in every Python worker")
+	parser.add_argument("--trainer", choices=["spark", "local"], default="spark",
+		help="Spark ML cross-validation, or collect the labeled vectors and fit with SciPy on this machine")
+	parser.add_argument("--scored-table",
+		help="save the scored comments with their probabilities here, as Parquet, or read them back without the score stage")
+	parser.add_argument("--stages", type=lambda text: text.split(","), default=STAGES,
+		help="comma separated stages to run out of train (Tasks 1-7), score (8-9) and aggregate (10), all by default")
+	parser.add_argument("--output-dir", default=".", help="directory the Task 10 outputs are written to")
+	parser.add_argument("--output-format", choices=["csv", "parquet"], default="csv")
+	parser.add_argument("--output-partitions", type=int, default=1,
+		help="part files per output, 0 writes one per task instead of funnelling each output through one")
+	parser.add_argument("--shuffle-partitions", help="spark.sql.shuffle.partitions, or auto to size it to the input")
+	parser.add_argument("--master", default="local[*]")
+	parser.add_argument("--driver-memory", help="e.g. 8g, the driver collects the vocabulary and the labeled set")
+	parser.add_argument("--executor-memory", help="e.g. 4g")
+	parser.add_argument("--arrow", action="store_true", help="also use Arrow for toPandas and createDataFrame")
+	parser.add_argument("--arrow-batch-size", type=int, help="rows per Arrow batch sent to the pandas UDFs")
+	parser.add_argument("--config", help="JSON file of defaults for these options, keyed by their names, e.g. output_format")
+	# A config file sets the defaults, options on the command line still win
+	configArgs, _ = parser.parse_known_args()
+	if configArgs.config:
+		with open(configArgs.config) as config:
+			parser.set_defaults(**json.load(config))
+	args = parser.parse_args()
+	unknown = [stage for stage in args.stages if stage not in STAGES]
+	if unknown:
+		parser.error("unknown stages: {}".format(", ".join(unknown)))
+	if "aggregate" in args.stages and "score" not in args.stages and not args.scored_table:
+		parser.error("aggregating without scoring needs the --scored-table of an earlier run")
+	if "score" in args.stages and "aggregate" not in args.stages and not args.scored_table:
+		parser.error("scoring without aggregating needs --scored-table to keep the scores")
+
 	conf = SparkConf().setAppName("CS143 Project 2B")
-	conf = conf.setMaster("local[*]")
+	conf = conf.setMaster(args.master)
+	if args.profile_dir:
+		conf = conf.set("spark.python.profile", "true")
+	if args.driver_memory:
+		conf = conf.set("spark.driver.memory", args.driver_memory)
+	if args.executor_memory:
+		conf = conf.set("spark.executor.memory", args.executor_memory)
+	if args.arrow:
+		# The Spark 2.3 name and the Spark 3 one, pandas UDFs use Arrow either way
+		conf = conf.set("spark.sql.execution.arrow.enabled", "true").set("spark.sql.execution.arrow.pyspark.enabled", "true")
+	if args.arrow_batch_size:
+		conf = conf.set("spark.sql.execution.arrow.maxRecordsPerBatch", str(args.arrow_batch_size))
 	sc   = SparkContext(conf=conf)
 	sqlContext = SQLContext(sc)
 	sc.addPyFile("cleantext.py")
-	main(sqlContext)
\ No newline at end of file
+	main(sqlContext, args.features, args.num_features, args.min_df, args.cache_dir,
+		args.comments, args.submissions, args.labeled,
+		args.model_dir, args.retrain, args.score_only, args.model_version, args.keep_models,
+		args.incremental, args.state_dir, args.tuning, args.parallelism, args.report, args.profile_dir,
+		args.dedup, args.sanitize_cache, args.trainer, args.scored_table,
+		args.stages, args.output_dir, args.output_format, args.output_partitions, args.shuffle_partitions)
+	if args.cache_dir and args.prune_cache is not None:
+		pruneCache(args.cache_dir, max(1, args.prune_cache))
\ No newline at end of file
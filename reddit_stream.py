@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+"""Score /r/politics comments as they arrive and keep per-day and per-state sentiment up to date."""
+
+from __future__ import print_function
+
+import os
+import json
+import argparse
+from pyspark import SparkConf, SparkContext
+from pyspark.sql import SQLContext
+from pyspark.sql.functions import from_json, expr
+from reddit_model import COMMENTS_SCHEMA, SUBMISSIONS, registerInputs, registerSanitize, scoringComments, \
+	classify, featurizer, loadModels, latestModelVersion
+
+def readComments(context, sourceDir=None, socket=None, maxFilesPerTrigger=None):
+	"""Returns the stream of comments dropped as JSON lines files into sourceDir, or sent to a socket."""
+	if socket:
+		host, port = socket.rsplit(":", 1)
+		lines = context.readStream.format("socket").option("host", host).option("port", int(port)).load()
+		return lines.select(from_json(lines.value, COMMENTS_SCHEMA).alias("comment")).select("comment.*")
+	reader = context.readStream.schema(COMMENTS_SCHEMA)
+	if maxFilesPerTrigger:
+		reader = reader.option("maxFilesPerTrigger", maxFilesPerTrigger)
+	return reader.json(sourceDir)
+
+def scoredStream(context, commentsDF, models, submissions=SUBMISSIONS, watermark="1 day"):
+	"""Scores a comment stream with saved models, the same way reddit_model scores the dumps."""
+	features, cv_model, posModel, negModel = models
+	registerSanitize(context)
+	# A stream-static join: the submissions are read once and broadcast to every micro-batch
+	registerInputs(context, None, submissions, None)
+	commentsDF.createOrReplaceTempView("comments")
+	scored = classify(context, cv_model.transform(scoringComments(context, featurizer(features)[0])), posModel, negModel)
+	# Windows older than the watermark are final and their state is dropped, which bounds the state kept
+	return scored.withColumn("event_time", scored.timestamp.cast("timestamp")).withWatermark("event_time", watermark)
+
+# Seconds in each unit of a watermark delay like "1 day" or "30 minutes"
+UNITS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400, "week": 604800}
+
+def intervalSeconds(text):
+	"""Returns the seconds of an interval as given to withWatermark, e.g. "1 day" or "2 hours 30 minutes"."""
+	words = text.split()
+	return sum(float(count) * UNITS[unit.lower().rstrip("s")] for count, unit in zip(words[::2], words[1::2]))
+
+# The columns of the outputs after their keys, as in the reddit_model outputs
+TOTALS = ["Positive", "Negative", "sum_pos", "sum_neg", "count"]
+
+class StreamAggregates(object):
+	"""Per-day and per-state sums and counts of the scored stream, updated by foreachBatch from each micro-batch.
+
+	The totals are small (a row per day and state) and kept on the driver, saved next to the
+	query's checkpoint so a restarted query carries on from them.
+	"""
+
+	def __init__(self, context, sink="console", output=None, checkpoint=None, watermark="1 day"):
+		self.context = context
+		self.sink = sink
+		self.output = output
+		self.delay = intervalSeconds(watermark)
+		self.path = os.path.join(checkpoint, "aggregates.json") if checkpoint else None
+		self.lastBatch = -1
+		self.watermark = None
+		# (date, state) -> [sum_pos, sum_neg, count, first timestamp]
+		self.totals = {}
+		if self.path and os.path.exists(self.path):
+			with open(self.path) as saved:
+				state = json.load(saved)
+			self.lastBatch, self.watermark = state["batch"], state["watermark"]
+			self.totals = dict(((date, flair), values) for date, flair, values in state["totals"])
+
+	def __call__(self, batch, batchId):
+		if batchId <= self.lastBatch:
+			# Replayed after a restart, it is already counted
+			return
+		if self.watermark is not None:
+			# Comments later than the watermark are dropped, their day may already be written
+			batch = batch.where(batch.timestamp >= self.watermark)
+		# The micro-batch is read, sanitized and scored once, for one small aggregate that gives
+		# both outputs: the per-day totals are summed from the per-state ones
+		rows = batch.groupBy("date", "state").agg(expr("SUM(pos) AS sum_pos"), expr("SUM(neg) AS sum_neg"),
+			expr("COUNT(*) AS count"), expr("MIN(timestamp) AS first"), expr("MAX(timestamp) AS last")).collect()
+		for row in rows:
+			values = self.totals.setdefault((row.date, row.state), [0, 0, 0, row.first])
+			values[0] += row.sum_pos
+			values[1] += row.sum_neg
+			values[2] += row["count"]
+			values[3] = min(values[3], row.first)
+		if rows:
+			latest = max(row.last for row in rows) - self.delay
+			self.watermark = latest if self.watermark is None else max(self.watermark, latest)
+		self.emit(set(row.date for row in rows))
+		self.lastBatch = batchId
+		self.save()
+
+	def outputs(self, dates):
+		"""Returns (name, columns, rows) of time_data and state_data for dates."""
+		daily = {}
+		states = []
+		for (date, flair), (sumPos, sumNeg, count, _) in sorted(self.totals.items()):
+			if date not in dates:
+				continue
+			day = daily.setdefault(date, [0, 0, 0])
+			day[0] += sumPos
+			day[1] += sumNeg
+			day[2] += count
+			if flair:
+				states.append((date, flair, sumPos / float(count), sumNeg / float(count), sumPos, sumNeg, count))
+		days = [(date, sumPos / float(count), sumNeg / float(count), sumPos, sumNeg, count)
+			for date, (sumPos, sumNeg, count) in sorted(daily.items())]
+		return [("time_data", ["date"] + TOTALS, days), ("state_data", ["date", "state"] + TOTALS, states)]
+
+	def emit(self, changed):
+		if self.sink in ("console", "memory"):
+			# Like the update output mode: the console shows the days that changed and memory
+			# tables hold every day. Days are never dropped, there are a few hundred a year.
+			dates = changed if self.sink == "console" else set(date for date, _ in self.totals)
+			for name, columns, rows in self.outputs(dates):
+				if not rows:
+					continue
+				table = self.context.createDataFrame(rows, columns)
+				if self.sink == "console":
+					print("{}:".format(name))
+					table.show(len(rows), truncate=False)
+				else:
+					table.createOrReplaceTempView(name)
+			return
+		# Like the append output mode: a day is written once the watermark passes its end, then dropped
+		final = set(date for (date, _), values in self.totals.items()
+			if self.watermark is not None and values[3] + 86400 <= self.watermark)
+		for name, columns, rows in self.outputs(final):
+			if rows:
+				self.context.createDataFrame(rows, columns).write.mode("append").format(self.sink) \
+					.save(os.path.join(self.output, name))
+		for key in [key for key in self.totals if key[0] in final]:
+			del self.totals[key]
+
+	def save(self):
+		if not self.path:
+			return
+		if not os.path.isdir(os.path.dirname(self.path)):
+			os.makedirs(os.path.dirname(self.path))
+		with open(self.path + ".tmp", "w") as saved:
+			json.dump({"batch": self.lastBatch, "watermark": self.watermark,
+				"totals": [[date, flair, values] for (date, flair), values in self.totals.items()]}, saved)
+		os.rename(self.path + ".tmp", self.path)
+
+def startQueries(context, scored, sink="console", output=None, checkpoint=None, trigger="10 seconds", watermark="1 day"):
+	"""Starts the per-day and per-state average queries, returns them."""
+	if hasattr(scored.writeStream, "foreachBatch"):
+		# Spark 2.4+: one query scores each micro-batch once and updates both outputs
+		writer = scored.writeStream.queryName("sentiment").trigger(processingTime=trigger)
+		if checkpoint:
+			writer = writer.option("checkpointLocation", os.path.join(checkpoint, "sentiment"))
+		return [writer.foreachBatch(StreamAggregates(context, sink, output, checkpoint, watermark)).start()]
+	
+	# Before 2.4 each aggregate is its own query, and every micro-batch is read, sanitized and scored twice
+	scored.createOrReplaceTempView("scoredStream")
+	daily = context.sql("""SELECT
+		window(event_time, '1 day') AS window,
+		AVG(pos) AS Positive,
+		AVG(neg) AS Negative,
+		COUNT(*) AS count
+	FROM scoredStream
+	GROUP BY window(event_time, '1 day')
+	""")
+	states = context.sql("""SELECT
+		window(event_time, '1 day') AS window,
+		state,
+		AVG(pos) AS Positive,
+		AVG(neg) AS Negative,
+		COUNT(*) AS count
+	FROM scoredStream
+	WHERE state <> ''
+	GROUP BY window(event_time, '1 day'), state
+	""")
+
+	queries = []
+	for name, aggregate in [("time_data", daily), ("state_data", states)]:
+		writer = aggregate.writeStream.queryName(name).trigger(processingTime=trigger)
+		if checkpoint:
+			writer = writer.option("checkpointLocation", os.path.join(checkpoint, name))
+		if sink in ("console", "memory"):
+			# Every trigger shows the windows that changed
+			writer = writer.outputMode("update").format(sink)
+		else:
+			# Files can only be appended to, a window is written once the watermark passes it
+			writer = writer.outputMode("append").format(sink).option("path", os.path.join(output, name))
+		queries.append(writer.start())
+	return queries
+
+def main(context, args):
+	version = args.model_version or latestModelVersion(args.model_dir)
+	models = loadModels(args.model_dir, version)
+	if models is None:
+		raise ValueError("No trained models of version {} in {}, run reddit_model.py first".format(version, args.model_dir))
+	commentsDF = readComments(context, args.source_dir, args.socket, args.max_files_per_trigger)
+	scored = scoredStream(context, commentsDF, models, args.submissions, args.watermark)
+	queries = startQueries(context, scored, args.sink, args.output, args.checkpoint, args.trigger, args.watermark)
+	for query in queries:
+		query.awaitTermination()
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__)
+	source = parser.add_mutually_exclusive_group(required=True)
+	source.add_argument("--source-dir", help="directory new comment files (JSON lines) are dropped into")
+	source.add_argument("--socket", help="host:port sending one JSON comment per line, a stand-in for a live feed")
+	parser.add_argument("--submissions", default=SUBMISSIONS)
+	parser.add_argument("--model-dir", default="project2")
+	parser.add_argument("--model-version", help="saved model version, the latest by default")
+	parser.add_argument("--watermark", default="1 day", help="how late a comment may arrive and still be counted")
+	parser.add_argument("--trigger", default="10 seconds", help="micro-batch interval")
+	parser.add_argument("--max-files-per-trigger", type=int)
+	parser.add_argument("--sink", default="console", choices=["console", "memory", "parquet", "csv"])
+	parser.add_argument("--output", default="stream_output", help="output directory of the parquet and csv sinks")
+	parser.add_argument("--checkpoint", default="stream_checkpoint")
+	args = parser.parse_args()
+
+	conf = SparkConf().setAppName("CS143 Project 2B streaming")
+	conf = conf.setMaster("local[*]")
+	sc   = SparkContext(conf=conf)
+	sqlContext = SQLContext(sc)
+	sc.addPyFile("cleantext.py")
+	main(sqlContext, args)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+"""Roll the sentiment outputs of reddit_model up into coarser groups, without running Spark again."""
+
+from __future__ import print_function
+
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+
+# US Census regions, by state name as in the flairs
+REGIONS = {
+	'Northeast': ['Connecticut', 'Maine', 'Massachusetts', 'New Hampshire', 'New Jersey', 'New York',
+		'Pennsylvania', 'Rhode Island', 'Vermont'],
+	'Midwest': ['Illinois', 'Indiana', 'Iowa', 'Kansas', 'Michigan', 'Minnesota', 'Missouri', 'Nebraska',
+		'North Dakota', 'Ohio', 'South Dakota', 'Wisconsin'],
+	'South': ['Alabama', 'Arkansas', 'Delaware', 'District of Columbia', 'Florida', 'Georgia', 'Kentucky',
+		'Louisiana', 'Maryland', 'Mississippi', 'North Carolina', 'Oklahoma', 'South Carolina', 'Tennessee',
+		'Texas', 'Virginia', 'West Virginia'],
+	'West': ['Alaska', 'Arizona', 'California', 'Colorado', 'Hawaii', 'Idaho', 'Montana', 'Nevada',
+		'New Mexico', 'Oregon', 'Utah', 'Washington', 'Wyoming'],
+}
+STATE_REGIONS = dict((state, region) for region, states in REGIONS.items() for state in states)
+
+def averages(totals):
+	"""Adds Positive and Negative, the exact averages of the sums and counts."""
+	totals = totals.copy()
+	totals['Positive'] = totals['sum_pos'] / totals['count']
+	totals['Negative'] = totals['sum_neg'] / totals['count']
+	return totals
+
+def rollup(table, key):
+	"""Sums a table's sums and counts by key (a column, or a Series aligned with the table) and averages them."""
+	if 'count' not in table:
+		raise ValueError("The table has no sums and counts, it was written before they were added, rerun reddit_model.py")
+	return averages(table.groupby(key)[['sum_pos', 'sum_neg', 'count']].sum())
+
+def by_period(time_data, period='W'):
+	"""Rolls daily sentiment up into periods, 'W' (weeks), 'M' (months) or any pandas period alias."""
+	days = pd.to_datetime(time_data['date'], format='%Y-%m-%d')
+	return rollup(time_data, days.dt.to_period(period).rename('period'))
+
+def by_region(state_data, regions=STATE_REGIONS):
+	"""Rolls per state sentiment up into regions, a dict from state to region name."""
+	return rollup(state_data, state_data['state'].map(regions).rename('region'))
+
+def rolling(time_data, days=7):
+	"""Returns the sentiment of the days ending on each day, over all comments of those days."""
+	daily = rollup(time_data, pd.to_datetime(time_data['date'], format='%Y-%m-%d').rename('date'))
+	# Days with no comments count as zeros, so the window is always days long
+	daily = daily[['sum_pos', 'sum_neg', 'count']].asfreq('D', fill_value=0)
+	return averages(daily.rolling(days, min_periods=1).sum())
+
+def confidence(table, z=1.96):
+	"""Adds Wilson score intervals of Positive and Negative, z=1.96 for 95%."""
+	table = table.copy()
+	count = table['count'].astype(float)
+	for column, sums in [('Positive', 'sum_pos'), ('Negative', 'sum_neg')]:
+		# pos and neg are 1/0 per comment, so each average is a proportion
+		share = table[sums] / count
+		center = (share + z * z / (2 * count)) / (1 + z * z / count)
+		margin = z * np.sqrt(share * (1 - share) / count + z * z / (4 * count * count)) / (1 + z * z / count)
+		table[column + '_low'] = center - margin
+		table[column + '_high'] = center + margin
+	return table
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--input-dir', default='.', help="directory with the outputs of reddit_model.py")
+	grouping = parser.add_mutually_exclusive_group(required=True)
+	grouping.add_argument('--period', help="roll time_data up into periods, e.g. W or M")
+	grouping.add_argument('--rolling', type=int, metavar='DAYS', help="rolling window over time_data")
+	grouping.add_argument('--regions', action='store_true', help="roll state_data up into Census regions")
+	parser.add_argument('--confidence', type=float, metavar='Z', help="add confidence intervals, e.g. 1.96")
+	args = parser.parse_args(argv)
+
+	# analysis knows how to read the outputs
+	from analysis import read_output
+	if args.regions:
+		table = by_region(read_output(args.input_dir, 'state_data'))
+	elif args.period:
+		table = by_period(read_output(args.input_dir, 'time_data'), args.period)
+	else:
+		table = rolling(read_output(args.input_dir, 'time_data'), args.rolling)
+	if args.confidence:
+		table = confidence(table, args.confidence)
+	table.to_csv(sys.stdout)
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
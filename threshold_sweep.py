@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+"""Try many positive/negative thresholds at once on a scored table kept by reddit_model.py --scored-table."""
+
+from __future__ import print_function
+
+import os
+import csv
+import argparse
+from pyspark import SparkConf, SparkContext
+from pyspark.sql import SQLContext
+from reddit_model import POS_TEST, NEG_TEST, SCORED_SCHEMA, latestModelVersion
+
+# Thresholds tried by default, 0.05 to 0.95
+THRESHOLDS = [round(0.05 * i, 2) for i in range(1, 20)]
+
+def testMetrics(context, path, thresholds):
+	"""Returns (threshold, precision, recall, F1) on the held out comments saved with a model."""
+	# The held out splits are a few thousand rows
+	rows = context.read.parquet(path).collect()
+	metrics = []
+	for threshold in thresholds:
+		truePositives = sum(1 for row in rows if row.probability > threshold and row.label == 1)
+		predicted = sum(1 for row in rows if row.probability > threshold)
+		actual = sum(1 for row in rows if row.label == 1)
+		precision = truePositives / float(predicted) if predicted else 0.0
+		recall = truePositives / float(actual) if actual else 0.0
+		f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+		metrics.append((threshold, precision, recall, f1))
+	return metrics
+
+# The groupings of the Task 10 outputs, as in reddit_model.aggregatePartials, with a total over everything
+DIMENSIONS = ["title", "date", "state", "comment_score", "story_score"]
+
+def thresholdCounts(context, scored, thresholds):
+	"""Counts the comments above every threshold, overall and per Task 10 grouping, in one pass.
+
+	Returns rows of dimension, key, count and pos_<i>, neg_<i>, the comments whose probability is above thresholds[i].
+	"""
+	context.read.schema(SCORED_SCHEMA).parquet(scored).createOrReplaceTempView("scored")
+	dimension = "".join("WHEN GROUPING({0}) = 0 THEN '{0}' ".format(name) for name in DIMENSIONS)
+	key = ", ".join("CAST({} AS STRING)".format(name) for name in DIMENSIONS)
+	above = ",\n\t\t".join("SUM(CASE WHEN {0}_probability > {1!r} THEN 1 ELSE 0 END) AS {0}_{2}".format(side, threshold, index)
+		for index, threshold in enumerate(thresholds) for side in ["pos", "neg"])
+	groups = ", ".join(DIMENSIONS)
+	return context.sql("""SELECT
+		CASE {0}ELSE 'total' END AS dimension,
+		COALESCE({1}, '') AS key,
+		COUNT(*) AS count,
+		{2}
+	FROM scored
+	GROUP BY {3}
+	GROUPING SETS ((), {4})
+	""".format(dimension, key, above, groups, ", ".join("({})".format(name) for name in DIMENSIONS))).collect()
+
+def sweep(rows, thresholds):
+	"""Returns (dimension, key, threshold, Positive, Negative, count) for every group and threshold."""
+	results = []
+	for row in sorted(rows, key=lambda row: (row.dimension, row.key)):
+		# Comments without a state flair are not in state_data either
+		if row.dimension == "state" and not row.key:
+			continue
+		total = row["count"]
+		for index, threshold in enumerate(thresholds):
+			results.append((row.dimension, row.key, threshold,
+				row["pos_{}".format(index)] / float(total), row["neg_{}".format(index)] / float(total), total))
+	return results
+
+def writeCsv(path, header, rows):
+	with open(path, "w") as saved:
+		writer = csv.writer(saved)
+		writer.writerow(header)
+		writer.writerows(rows)
+	print("Wrote {}".format(path))
+
+def main(context, args):
+	thresholds = args.thresholds or THRESHOLDS
+	if not os.path.isdir(args.output):
+		os.makedirs(args.output)
+
+	version = args.model_version or latestModelVersion(args.model_dir)
+	posMetrics = testMetrics(context, os.path.join(args.model_dir, version, POS_TEST), thresholds)
+	negMetrics = testMetrics(context, os.path.join(args.model_dir, version, NEG_TEST), thresholds)
+	writeCsv(os.path.join(args.output, "test_metrics.csv"),
+		["threshold", "pos_precision", "pos_recall", "pos_f1", "neg_precision", "neg_recall", "neg_f1"],
+		[pos + neg[1:] for pos, neg in zip(posMetrics, negMetrics)])
+
+	writeCsv(os.path.join(args.output, "sweep.csv"), ["dimension", "key", "threshold", "Positive", "Negative", "count"],
+		sweep(thresholdCounts(context, args.scored_table, thresholds), thresholds))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument("--scored-table", default="scored_comments", help="the --scored-table of reddit_model.py")
+	parser.add_argument("--model-dir", default="project2")
+	parser.add_argument("--model-version", help="saved model version, the latest by default")
+	parser.add_argument("--thresholds", type=float, nargs="+", help="thresholds to try, 0.05 to 0.95 by default")
+	parser.add_argument("--output", default="threshold_sweep", help="directory for test_metrics.csv and sweep.csv")
+	args = parser.parse_args()
+
+	conf = SparkConf().setAppName("CS143 Project 2B threshold sweep")
+	conf = conf.setMaster("local[*]")
+	sc   = SparkContext(conf=conf)
+	sqlContext = SQLContext(sc)
+	main(sqlContext, args)